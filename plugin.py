@@ -12,7 +12,10 @@
         <param field="Address" label="Inverter IP Address" width="200px" required="true" default="5.8.8.8"/>
         <param field="Port" label="Port" width="40px" required="true" default="502"/>
         <param field="Mode2" label="Inverter ModBus Unit ID" width="20px" required="true" default="1"/>
+        <param field="Mode3" label="Additional targets (host:port:unitId:unitOffset[:ev], ...)" width="300px" default="" />
         <param field="Mode1" label="Update interval (seconds)" width="20px" default="10" />
+        <param field="Mode4" label="Tariff 2 schedule (HH:MM-HH:MM, ...)" width="200px" default="" />
+        <param field="Mode5" label="Advanced settings (key=value;...)" width="300px" default="" />
         <param field="Mode6" label="Debug" width="80px">
             <options>
                 <option label="True" value="Debug"/>
@@ -25,12 +28,21 @@
 
 
 import Domoticz
-from pymodbus.client import ModbusTcpClient
-from pymodbus.payload import BinaryPayloadDecoder
-from pymodbus.payload import BinaryPayloadBuilder
-from pymodbus.constants import Endian
-from datetime import datetime
+from pymodbus.client import ModbusTcpClient, AsyncModbusTcpClient
+from pymodbus.pdu import ExceptionResponse
+from array import array
+import asyncio
+import concurrent.futures
+import json
+import mmap
+import os
+import threading
+import queue
+import socket
+import struct
+import sys
 import time
+import zlib
 
 
 class BasePlugin:
@@ -43,13 +55,95 @@ class BasePlugin:
         'port': '502',
         'updateInterval': 10,
         'unitId': 1,
-        'maxPower': 8000,
-        'evCharger': False,
+        'readGap': 10,
+        'readBlock': 50,
+        'timeout': 3,
+        'retries': 2,
+        'powerDeadband': 10,
+        'adaptivePolling': 0,
+        'pollMin': 5,
+        'pollMax': 60,
+        'pollVolatility': 300,
+        'pollSteady': 50,
+        'historySize': 720,
+        'historyFile': 1,
+        'energyGap': 300,
+        'tariffSchedule': [],
+        'diagnostics': 0,
+        'metricsFile': 0,
+        'record': 0,
+        'recordSize': 10,
+        'rcMinInterval': 5,
+        'evInterval': 10,
+        'evGap': 1000,
+        'asyncTransport': 0,
+        'inFlight': 2,
+        'publishQueue': 1000,
+        'mqtt': '',
+        'mqttTopic': 'solax',
+        'influxFile': 0,
+        'influxUdp': '',
+        'sampleInterval': 0,
+        'sampleBuffer': 600,
+        'counterMaxPower': 30000,
         }
 
+    __ADVANCED_SETTINGS = {
+        # key: (min, max) - integer settings adjustable via Mode5
+        'readGap': (0, 100),
+        'readBlock': (1, 125),
+        'timeout': (1, 30),
+        'retries': (0, 5),
+        'powerDeadband': (0, 1000),
+        'adaptivePolling': (0, 1),
+        'pollMin': (1, 600),
+        'pollMax': (1, 600),
+        'pollVolatility': (1, 100000),
+        'pollSteady': (0, 100000),
+        'historySize': (2, 100000),
+        'historyFile': (0, 1),
+        'energyGap': (10, 86400),
+        'diagnostics': (0, 1),
+        'metricsFile': (0, 1),
+        'record': (0, 1),
+        'recordSize': (1, 1000),
+        'rcMinInterval': (0, 600),
+        'evInterval': (2, 3600),
+        'evGap': (0, 10000),
+        'asyncTransport': (0, 1),
+        'inFlight': (1, 16),
+        'publishQueue': (10, 100000),
+        'influxFile': (0, 1),
+        'sampleInterval': (0, 60000),
+        'sampleBuffer': (10, 100000),
+        'counterMaxPower': (1000, 1000000),
+        }
+
+    # Text settings adjustable via Mode5
+    __TEXT_SETTINGS = ['mqtt', 'mqttTopic', 'influxUdp']
+
+    # Minimum time between two checkpoints of the plugin state (seconds)
+    __STATE_INTERVAL = 300
 
-    commInProgress = False
-    lastEVEnergy = 0
+    # Minimum time between two exports of the metrics files (seconds)
+    __METRICS_INTERVAL = 60
+
+
+    registerMaps = {}
+    targets = []
+    unitTargets = {}
+    links = {}
+    workers = {}
+    eventLoop = None
+    publisher = None
+    deviceUpdates = None
+    state = None
+    stateSaved = 0
+    metrics = None
+    metricsExported = 0
+    configPlan = None
+    rcPlan = None
+    samplePlan = None
 
     # Inverter section
     # ================
@@ -72,7 +166,7 @@ class BasePlugin:
         [13, "To Grid Energy", 243, 29, 0, {}, 1],
         [14, "From Grid Energy", 243, 29, 0, {}, 1],
         [15, "Inverter Energy", 243, 29, 0, {}, 1],
-        [16, "Local Energy Consumption", 243, 29, 0, {'EnergyMeterMode':'1' }, 1],
+        [16, "Local Energy Consumption", 243, 29, 0, {'EnergyMeterMode':'0' }, 1],
         [17, "Off-Grid Energy", 243, 29, 0, {}, 1],
         # Smart meters
         [20, "Total Grid Energy", 250, 1, 0, {}, 1],
@@ -103,9 +197,100 @@ class BasePlugin:
         [67, "Control - Remote Control Trigger", 244, 73, 9, {}, 1],
     ]
 
+    __DIAGNOSTIC_UNITS = [
+        # id, name, type, subtype, switchtype, options, used
+        # Created for every target when diagnostics are enabled
+        [70, "Diagnostics - Cycle Time", 243, 31, 0, {'Custom': '1;ms'}, 1],
+        [71, "Diagnostics - Requests per Cycle", 243, 31, 0, {'Custom': '1;requests'}, 1],
+        [72, "Diagnostics - Bytes per Cycle", 243, 31, 0, {'Custom': '1;B'}, 1],
+        [73, "Diagnostics - Request Error Rate", 243, 6, 0, {}, 1],
+        [74, "Diagnostics - Retries", 243, 31, 0, {'Custom': '1;retries'}, 1],
+        [75, "Diagnostics - Skipped Device Writes", 243, 6, 0, {}, 1],
+    ]
+
+    __INVERTER_REGISTERS = [
+        # name, offset, type, scale, unit, format
+        # Input registers; unit/format are set for fields published as is
+        ['inverterPower', 0x0002, 'int16', 1, 1, "{}"],
+        ['inverterTemperature', 0x0008, 'uint16', 1, 31, "{}"],
+        ['runMode', 0x0009, 'uint16', 1, 0, None],
+        ['pv1Power', 0x000a, 'uint16', 1, 2, "{}"],
+        ['pv2Power', 0x000b, 'uint16', 1, 3, "{}"],
+        ['batteryPower', 0x0016, 'int16', 1, 5, "{}"],
+        ['batteryTemperature', 0x0018, 'uint16', 1, 32, "{}"],
+        ['gridStatus', 0x001a, 'uint16', 1, 0, None],
+        ['batteryCapacity', 0x001c, 'uint16', 1, 30, "{}"],
+        ['batteryOutEnergy', 0x001d, 'uint32', 100, 0, None],
+        ['batteryInEnergy', 0x0021, 'uint32', 100, 0, None],
+        ['gridPower', 0x0046, 'int32', 1, 6, "{}"],
+        ['gridExportEnergy', 0x0048, 'uint32', 10, 0, None],
+        ['gridImportEnergy', 0x004a, 'uint32', 10, 0, None],
+        ['offGridPower', 0x004e, 'int16', 1, 8, "{}"],
+        ['inverterEnergy', 0x0052, 'uint32', 100, 0, None],
+        ['offGridEnergy', 0x008e, 'int32', 100, 0, None],
+        ['pvEnergy', 0x0094, 'uint32', 100, 0, None],
+        ['rcMode', 0x0100, 'uint16', 1, 0, None],
+        ['rcTimeoutActive', 0x0101, 'uint16', 1, 0, None],
+        ['rcPowerTarget', 0x0102, 'int32', 1, 50, "{}"],
+        ['rcEnergyTarget', 0x0112, 'int32', 1, 51, "{}"],
+        ['rcChargerPower', 0x0114, 'int32', 1, 53, "{}"],
+        ['rcDurationTime', 0x011a, 'uint16', 1, 56, "{}"],
+        ['rcSOCTarget', 0x011b, 'uint16', 1, 52, "{}"],
+        ['rcTimeOut', 0x011e, 'uint16', 1, 57, "{}"],
+    ]
+
+    __INVERTER_DERIVED = [
+        # unit, fields - devices computed from several registers
+        [4, ['pv1Power', 'pv2Power']],
+        [7, ['inverterPower', 'gridPower']],
+        [10, ['pv1Power', 'pv2Power', 'pvEnergy']],
+        [11, ['batteryPower', 'batteryInEnergy', 'batteryOutEnergy']],
+        [12, ['batteryPower', 'batteryInEnergy', 'batteryOutEnergy']],
+        [13, ['gridPower', 'gridExportEnergy', 'gridImportEnergy']],
+        [14, ['gridPower', 'gridExportEnergy', 'gridImportEnergy']],
+        [15, ['inverterPower', 'inverterEnergy']],
+        [16, ['inverterPower', 'gridPower', 'inverterEnergy', 'gridExportEnergy', 'gridImportEnergy']],
+        [17, ['offGridPower', 'offGridEnergy']],
+        [20, ['gridPower', 'gridExportEnergy', 'gridImportEnergy']],
+        [21, ['gridPower', 'gridExportEnergy', 'gridImportEnergy']],
+        [33, ['runMode']],
+        [34, ['gridStatus']],
+        [54, ['rcMode']],
+        [55, ['rcTimeoutActive']],
+    ]
+
+    # Fields always read when adaptive polling is enabled
+    __ADAPTIVE_FIELDS = ['inverterPower', 'runMode', 'pv1Power', 'pv2Power', 'batteryPower', 'gridPower', 'rcMode']
+
+    # Run modes with nothing to follow - Waiting, Idle, Standby
+    __IDLE_RUN_MODES = (0, 9, 10)
+
+    __CONFIG_REGISTERS = [
+        # name, offset, type, scale, unit, format
+        # Holding registers
+        ['serialNumber', 0x0000, 'string14', 1, 0, None],
+        ['maxPower', 0x00ba, 'uint16', 1, 0, None],
+        ['externalDevices', 0x013e, 'uint16', 1, 0, None],
+    ]
+
+    # Power and energy devices where changes below powerDeadband are not
+    # published. No device value is read back, tariff and energy totals come
+    # from the registers, so a held back update loses no energy; the next
+    # published value carries the full total.
+    __DEADBAND_UNITS = [1, 2, 3, 4, 5, 6, 7, 8, 10, 11, 12, 13, 14, 15, 16, 17, 20, 21]
+
     __RUN_MODES = ("Waiting", "Checking", "Normal", "Fault", "Permanent Fault", "Update", "Off-grid waiting", "Off-grid", "Self Testing", "Idle", "Standby")
     __REMOTECONTROL_MODES = ("Disabled", "Power control", "Energy control", "SOC control", "Push power", "Push power - zero", "self consume", "self consume - charge only")
 
+    # Monotonic energy counters (uint32, Wh) checked by the counter filter
+    __COUNTER_FIELDS = ['batteryOutEnergy', 'batteryInEnergy', 'gridExportEnergy', 'gridImportEnergy', 'inverterEnergy', 'pvEnergy', 'evEnergy']
+
+    # Power registers read by the fast sampler
+    __SAMPLE_FIELDS = ['inverterPower', 'pv1Power', 'pv2Power', 'batteryPower', 'gridPower', 'offGridPower']
+
+    # Read back of a remote control write
+    __RC_FIELDS = ['rcMode', 'rcTimeoutActive', 'rcPowerTarget', 'rcEnergyTarget', 'rcChargerPower', 'rcDurationTime', 'rcSOCTarget', 'rcTimeOut']
+
     __RC_SETTINGS = {
         'PowerTarget': 0,
         'EnergyTarget': 0,
@@ -116,6 +301,20 @@ class BasePlugin:
         'Mode': 0,
         }
 
+    # Remote control settings kept in setpoint / selector devices
+    __RC_UNITS = [
+        [60, 'PowerTarget'],
+        [61, 'EnergyTarget'],
+        [62, 'SOCTarget'],
+        [63, 'ChargerPower'],
+        [64, 'DurationTime'],
+        [65, 'TimeOut'],
+        [66, 'Mode'],
+    ]
+
+    # Devices with ValueMin / ValueMax following the inverter's max power
+    __POWER_UNITS = [60, 63]
+
     # EV Charger section
     # ==================
 
@@ -134,6 +333,33 @@ class BasePlugin:
 
     ]
 
+    __EV_INPUT_REGISTERS = [
+        # name, offset, type, scale, unit, format
+        ['evPower', 0x000b, 'uint16', 1, 100, "{}"],
+        ['evEnergy', 0x000f, 'uint32', 100, 0, None],
+        ['evTemperature', 0x001c, 'int16', 1, 130, "{}"],
+        ['evState', 0x001d, 'uint16', 1, 0, None],
+    ]
+
+    __EV_INPUT_DERIVED = [
+        # unit, fields
+        [110, ['evPower', 'evEnergy']],
+        [120, ['evState']],
+    ]
+
+    __EV_HOLDING_REGISTERS = [
+        # name, offset, type, scale, unit, format
+        ['evRunMode', 0x000d, 'uint16', 1, 0, None],
+        #['evMaxCurrent', 0x0028, 'uint16', 1, 0, None],
+    ]
+
+    __EV_HOLDING_DERIVED = [
+        # unit, fields
+        [121, ['evRunMode']],
+    ]
+
+    __EV_DEADBAND_UNITS = [100]
+
     __EV_STATE = ("Avaiable", "Preparing", "Charging", "Finishing", "Faulted", "Unavaiable", "Reserved", "Suspended EV", "Suspended EVSE", "Update", "Card Activation")
 
 
@@ -150,7 +376,8 @@ class BasePlugin:
             Domoticz.Debugging(0)
 
         Domoticz.Debug("onStart")
-        DumpConfigToLog()
+        if Parameters["Mode6"] == "Debug":
+            DumpConfigToLog()
 
         # Parse configuration
         try:
@@ -179,85 +406,147 @@ class BasePlugin:
         except:
             self.__SETTINGS['unitId'] = 1
 
-        # Read Inverter parameters
-        Domoticz.Debug("Reading configuration information from inverter.")
+        # Tariff 2 schedule - local time ranges, e.g. 22:00-06:00
+        self.__SETTINGS['tariffSchedule'] = []
+        for item in str(Parameters.get("Mode4", "")).split(','):
+            if not item.strip():
+                continue
+            try:
+                (start, end) = [time.strptime(value.strip(), '%H:%M') for value in item.split('-')]
+                self.__SETTINGS['tariffSchedule'].append((start.tm_hour * 60 + start.tm_min, end.tm_hour * 60 + end.tm_min))
+            except:
+                Domoticz.Error("Ignoring invalid tariff schedule entry: '{}'.".format(item.strip()))
+
+        # Advanced settings
+        for item in str(Parameters.get("Mode5", "")).split(';'):
+            key, sep, value = item.partition('=')
+            key = key.strip()
+            if not key:
+                continue
+            if key in self.__TEXT_SETTINGS:
+                self.__SETTINGS[key] = value.strip()
+                continue
+            try:
+                (low, high) = self.__ADVANCED_SETTINGS[key]
+                if not low <= int(value) <= high:
+                    raise ValueError
+                self.__SETTINGS[key] = int(value)
+            except:
+                Domoticz.Error("Ignoring invalid advanced setting: '{}'.".format(item.strip()))
 
-        self.commInProgress = True
+        # Device update pipeline
+        self.deviceUpdates = DeviceUpdates()
 
-        while True:
-            holdingRegisters = self.getHoldingRegisters(0, 374, 50)
-            if holdingRegisters:
-                break
-            Domoticz.Debug("There is issue to read Inverter configuration. Will ty it again after 10s.")
-            time.sleep(10)
+        # Performance metrics
+        self.metrics = Metrics()
 
-        decoder = BinaryPayloadDecoder.fromRegisters(holdingRegisters, byteorder=Endian.BIG, wordorder=Endian.LITTLE)
-        self.commInProgress = False
-        
-        # Inverter type - max power
-        decoder.reset()
-        decoder.skip_bytes(0x00ba * 2)
-        self.__SETTINGS['maxPower'] = decoder.decode_16bit_uint()
+        # Poll records for MQTT / InfluxDB
+        self.publisher = self.createPublisher()
 
-        # EV Charger check
-        decoder.reset()
-        decoder.skip_bytes(0x013e * 2)
-        val = decoder.decode_16bit_uint()
-        
-        Domoticz.Debug("External devices ModBus info: {}.".format(val))
+        # Persistent plugin state
+        self.state = StateStore(os.path.join(str(Parameters.get("HomeFolder", "")), "solax-{}.json".format(Parameters.get("HardwareID", 0))))
+        self.state.load()
 
-        if val in [1, 4, 6]:
-            self.__SETTINGS['evCharger'] = True
-            Domoticz.Debug("EV Charger is connected.")
-        else:
-            self.__SETTINGS['evCharger'] = False
-            Domoticz.Debug("EV Charger is NOT connected.")
+        # Compile register maps
+        self.registerMaps = self.compileRegisterMaps()
 
-        # Create Inverter devices
-        for unit in self.__UNITS:
-            if unit[0] not in Devices:
-                Domoticz.Device(
-                    Unit=unit[0],
-                    Name=unit[1],
-                    Type=unit[2],
-                    Subtype=unit[3],
-                    Switchtype=unit[4],
-                    Options=unit[5],
-                    Used=unit[6],
-                ).Create() 
-        
-        # Create EV Charger devices
-        if self.__SETTINGS['evCharger']:
-            for unit in self.__EV_UNITS:
-                if unit[0] not in Devices:
-                    Domoticz.Device(
-                        Unit=unit[0],
-                        Name=unit[1],
-                        Type=unit[2],
-                        Subtype=unit[3],
-                        Switchtype=unit[4],
-                        Options=unit[5],
-                        Used=unit[6],
-                    ).Create() 
-
-        # Change devices' options
-        Domoticz.Debug("Maximum inverter power is set to: {} Watt(s)".format(self.__SETTINGS['maxPower']))
-        Devices[60].Update(nValue=0, sValue="0", Options={'ValueStep':'100','ValueMin':'-' + str(self.__SETTINGS['maxPower']), 'ValueMax':str(self.__SETTINGS['maxPower']), 'ValueUnit':'W'})
-        Devices[63].Update(nValue=0, sValue="0", Options={'ValueStep':'100','ValueMin':'-' + str(self.__SETTINGS['maxPower']), 'ValueMax':str(self.__SETTINGS['maxPower']), 'ValueUnit':'W'})
-
-        # Heartbeat interval setup
+        # Targets - the main inverter plus optional additional inverters or
+        # separately addressed EV Chargers, each with its own unit offset
+        self.addTarget(self.__SETTINGS['address'], self.__SETTINGS['port'], self.__SETTINGS['unitId'], 0, 'inverter')
+        for item in str(Parameters.get("Mode3", "")).split(','):
+            if not item.strip():
+                continue
+            try:
+                fields = [field.strip() for field in item.split(':')]
+                (address, port, unitId, offset) = fields[0:4]
+                kind = fields[4] if len(fields) > 4 else 'inverter'
+                if kind not in ('inverter', 'ev') or not 1 <= int(unitId) <= 255:
+                    raise ValueError
+                self.addTarget(address, int(port), int(unitId), int(offset), kind)
+            except:
+                Domoticz.Error("Ignoring invalid target: '{}'.".format(item.strip()))
+
+        # Inverter parameters are taken from the cache of the last probe, the
+        # inverter itself is probed in the background once workers run
+        self.configPlan = self.planRegisterReads('config', 0, True, self.registerMaps['config'])
+        self.rcPlan = self.planRegisterReads('remote control', 0, False, self.registerMaps['inverter'].subset(self.__RC_FIELDS))
+        self.samplePlan = self.planRegisterReads('power samples', 0, False, self.registerMaps['inverter'].subset(self.__SAMPLE_FIELDS))
+
+        for target in self.targets:
+            if target['kind'] == 'inverter':
+                serial = self.state.data.get('targets', {}).get(target['name'])
+                identity = self.state.data.get('inverters', {}).get(serial)
+                if identity:
+                    Domoticz.Debug("Using cached configuration of inverter {} for {}.".format(serial, target['name']))
+                    target['serialNumber'] = serial
+                    self.configureTarget(target, identity)
+                else:
+                    Domoticz.Debug("No cached configuration for {}, using defaults until probed.".format(target['name']))
+
+            # Create or update Inverter devices
+            if target['kind'] == 'inverter':
+                self.syncDevices(target, self.__UNITS)
+                self.restoreRemoteControl(target)
+                
+            # Create or update EV Charger devices
+            if target['evCharger']:
+                self.syncDevices(target, self.__EV_UNITS)
+
+            # Create or update diagnostic devices
+            if self.__SETTINGS['diagnostics']:
+                self.syncDevices(target, self.__DIAGNOSTIC_UNITS)
+        self.state.save()
+
+        # ModBus I/O runs in one worker thread per host, so hosts are polled
+        # concurrently; the heartbeat is a short tick publishing the results
+        # while polling keeps the configured interval
         Domoticz.Debug("Update interval is set to: {} second(s)".format(self.__SETTINGS['updateInterval']))
-        Domoticz.Heartbeat(int(self.__SETTINGS['updateInterval']))
-
-        self.updateDevices()
+        for worker in self.workers.values():
+            worker.start()
+        Domoticz.Heartbeat(1)
+
+        for target in self.targets:
+            if target['kind'] == 'inverter':
+                self.probeTarget(target)
+            self.updateDevices(target)
+            if target['sampler'] is not None:
+                target['worker'].submit(self.samplePower, (target,), key=(target['name'], 'sample'))
     
     def onStop(self):
-        Domoticz.Debug("onStop called --> NoOp")
+        Domoticz.Debug("onStop called")
+
+        # Closing the links first aborts transactions still running, so the
+        # workers finish within their stop timeout
+        for link in self.links.values():
+            link.shutdown()
+        for worker in self.workers.values():
+            if worker.is_alive():
+                worker.stop()
+        for link in self.links.values():
+            if link.recorder is not None:
+                link.recorder.close()
+        if self.eventLoop is not None:
+            self.eventLoop.stop()
+        for target in self.targets:
+            for history in target['history'].values():
+                history.close()
+        self.saveState(True)
+        self.exportMetrics(True)
+        if self.publisher is not None:
+            self.publisher.stop()
 
     def onHeartbeat(self):
-        Domoticz.Debug("onHeartbeat")
-        
-        self.updateDevices()
+        for worker in self.workers.values():
+            worker.processResults()
+
+        now = time.monotonic()
+        for target in self.targets:
+            if now >= target['nextPoll']:
+                Domoticz.Debug("onHeartbeat - polling {}".format(target['name']))
+                self.updateDevices(target)
+            if target['kind'] == 'inverter' and target['evCharger'] and now >= target['evNextPoll']:
+                Domoticz.Debug("onHeartbeat - polling EV Charger of {}".format(target['name']))
+                self.updateEVCharger(target)
 
     def onCommand(self, Unit, Command, Level):
         Domoticz.Debug("onCommand")
@@ -266,569 +555,2666 @@ class BasePlugin:
         action, sep, params = Command.partition(' ')
         action = action.capitalize()       
 
+        if Unit not in self.unitTargets:
+            return
+        target = self.unitTargets[Unit]
+        rc = target['rc']
+        maxPower = target['maxPower']
+        Unit = Unit - target['offset']
+
         # Remote Control Targer Power
         if Unit == 60:
-            if -(self.__SETTINGS['maxPower']) <= Level <= self.__SETTINGS['maxPower']:
-                self.__RC_SETTINGS['PowerTarget'] = Level
+            if -(maxPower) <= Level <= maxPower:
+                rc['PowerTarget'] = Level
         # Remote Control Target Energy
         elif Unit == 61:
             if -12000 <= Level <= 12000:
-                self.__RC_SETTINGS['EnergyTarget'] = Level
+                rc['EnergyTarget'] = Level
         # Remote Control Target SoC
         elif Unit == 62:
             if 10 <= Level <= 100:
-                self.__RC_SETTINGS['SOCTarget'] = Level
+                rc['SOCTarget'] = Level
         # Remote Control Charge Power
         elif Unit == 63:
-            if -(self.__SETTINGS['maxPower']) <= Level <= self.__SETTINGS['maxPower']:
-                self.__RC_SETTINGS['ChargerPower'] = Level
+            if -(maxPower) <= Level <= maxPower:
+                rc['ChargerPower'] = Level
         # Remote Control Duration Time
         elif Unit == 64:
             if 0 <= Level <= 6000:
-                self.__RC_SETTINGS['DurationTime'] = Level
+                rc['DurationTime'] = Level
         # Remote Control TimoOut
         elif Unit == 65:    
             if 0 <= Level <= 6000:
-                self.__RC_SETTINGS['TimeOut'] = Level
+                rc['TimeOut'] = Level
         # Remote Control Mode
         elif Unit == 66:
             if Level in [0, 10, 20, 30, 40]: 
-                self.__RC_SETTINGS['Mode'] = Level
+                rc['Mode'] = Level
         # Remote Control Trigger
         elif Unit == 67:
-            self.startRemoteControl()
-            time.sleep(3)
-            self.updateDevices()
+            self.triggerRemoteControl(target)
             return
         # EV Charger Run Mode
         elif Unit == 121:
             if Level in [0, 10, 20, 30]: 
                 val = Level/10
-                self.updateInverter(0x100d, val)
-                time.sleep(2)
-                self.updateDevices()
+                self.updateReadPlans(target)
+                plan = target['readPlans']['evHolding']
+                target['worker'].submit(self.setEVRunMode, (target, val, plan),
+                    callback=lambda result: self.onEVRunMode(target, plan, result), priority=ModbusWorker.PRIORITY_WRITE)
             return
         # Tariff switch
         elif Unit == 39:
             if action == 'On':
-                UpdateDevice(39,1,"On")
+                self.getTariffMeter(target).tariff = 1
+                self.updateDevice(target, 39,1,"On")
             else:
-                UpdateDevice(39,0,"Off")
+                self.getTariffMeter(target).tariff = 0
+                self.updateDevice(target, 39,0,"Off")
         
-        self.updateLocalDevices()
-    
-    def updateInverter(self, register, value):
-        while self.commInProgress:
-            time.sleep(1)
+        self.updateLocalDevices(target)
+        self.deviceUpdates.flush()
+
+    def compileRegisterMaps(self):
+        # Also used offline by tools/decode.py
+        return {
+            'inverter': RegisterMap(self.__INVERTER_REGISTERS),
+            'config': RegisterMap(self.__CONFIG_REGISTERS),
+            'evInput': RegisterMap(self.__EV_INPUT_REGISTERS),
+            'evHolding': RegisterMap(self.__EV_HOLDING_REGISTERS),
+            }
+
+    def addTarget(self, address, port, unitId, offset, kind):
+        name = "{}:{}/{}".format(address, port, unitId)
+
+        # Reserve the unit range; EV Charger units of an inverter are only
+        # reserved when they fit into the Domoticz limit of 255 units
+        units = [unit[0] for unit in (self.__UNITS if kind == 'inverter' else self.__EV_UNITS)]
+        if self.__SETTINGS['diagnostics']:
+            units += [unit[0] for unit in self.__DIAGNOSTIC_UNITS]
+        evUnits = [unit[0] for unit in self.__EV_UNITS] if kind == 'inverter' else []
+        if not all(1 <= offset + unit <= 255 for unit in units):
+            raise ValueError("Units of {} do not fit into range 1 - 255.".format(name))
+        if not all(1 <= offset + unit <= 255 for unit in evUnits):
+            Domoticz.Log("EV Charger devices are not supported for {} with unit offset {}.".format(name, offset))
+            evUnits = []
+        reserved = [offset + unit for unit in units + evUnits]
+        if any(unit in self.unitTargets for unit in reserved):
+            raise ValueError("Units of {} overlap another target.".format(name))
+
+        # Transactions are serialized per host:port, shared by all unit IDs there
+        host = (address, port)
+        if host not in self.links:
+            recorder = None
+            if self.__SETTINGS['record']:
+                fileName = ''.join(c if c.isalnum() else '_' for c in "{}:{}".format(address, port))
+                path = os.path.join(str(Parameters.get("HomeFolder", "")), "solax-{}-{}.modbus".format(Parameters.get("HardwareID", 0), fileName))
+                recorder = TrafficRecorder(path, self.__SETTINGS['recordSize'] * 1024 * 1024)
+            if self.__SETTINGS['asyncTransport']:
+                if self.eventLoop is None:
+                    self.eventLoop = EventLoop()
+                self.links[host] = AsyncModbusLink(self.eventLoop, address, port, self.__SETTINGS['timeout'], self.__SETTINGS['retries'], recorder, self.__SETTINGS['inFlight'])
+            else:
+                self.links[host] = ModbusLink(address, port, self.__SETTINGS['timeout'], self.__SETTINGS['retries'], recorder)
+            self.workers[host] = ModbusWorker()
+
+        target = {
+            'name': name,
+            'unitId': unitId,
+            'offset': offset,
+            'kind': kind,
+            'evBase': 0x1000 if kind == 'inverter' else 0,
+            'evSupported': bool(evUnits) or kind == 'ev',
+            'evCharger': kind == 'ev',
+            'maxPower': 8000,
+            'serialNumber': None,
+            'rc': dict(self.__RC_SETTINGS),
+            'remoteControl': RemoteControl(),
+            'history': {},
+            'integrators': {},
+            'tariffMeter': None,
+            'evTotal': None,
+            'counterFilter': None,
+            'sampler': PowerSampler(self.__SAMPLE_FIELDS, self.__SETTINGS['sampleBuffer']) if self.__SETTINGS['sampleInterval'] and kind == 'inverter' else None,
+            'timedOut': False,
+            'cycleMarks': {},
+            'readPlans': {},
+            'planSignature': None,
+            'activeUnits': set(),
+            'pendingReads': set(),
+            'nextPoll': 0,
+            'evNextPoll': 0,
+            'pollStarted': 0,
+            'interval': self.__SETTINGS['updateInterval'],
+            'link': self.links[host],
+            'worker': self.workers[host],
+            }
+        self.targets.append(target)
+        for unit in reserved:
+            self.unitTargets[unit] = target
+        for unit in self.__DEADBAND_UNITS + self.__EV_DEADBAND_UNITS:
+            if offset + unit in reserved:
+                self.deviceUpdates.deadbands[offset + unit] = self.__SETTINGS['powerDeadband']
+        Domoticz.Debug("Target {} ({}) uses unit offset {}.".format(name, kind, offset))
+        return target
+
+    def configureTarget(self, target, values):
+        # Inverter type - max power
+        target['maxPower'] = values['maxPower']
+
+        # EV Charger check
+        val = values['externalDevices']
+        
+        Domoticz.Debug("External devices ModBus info of {}: {}.".format(target['name'], val))
 
-        self.commInProgress = True
+        if val in [1, 4, 6] and target['evSupported']:
+            target['evCharger'] = True
+            Domoticz.Debug("EV Charger is connected.")
+        else:
+            target['evCharger'] = False
+            Domoticz.Debug("EV Charger is NOT connected.")
+
+    def probeTarget(self, target, delay=0):
+        # Read inverter identity and capabilities (max power, EV Charger)
+        target['worker'].submit(self.readRegisterBlocks, (target, self.configPlan),
+            callback=lambda result: self.onProbe(target, result),
+            key=(target['name'], 'config'), delay=delay)
+
+    def onProbe(self, target, registers):
+        values = self.configPlan['map'].decode(registers) if registers else None
+        if values is None:
+            Domoticz.Debug("There is issue to read configuration of {}. Will ty it again after 10s.".format(target['name']))
+            self.probeTarget(target, 10)
+            return
+
+        identity = {
+            'maxPower': values['maxPower'],
+            'externalDevices': values['externalDevices'],
+            }
+        serial = values['serialNumber']
+        Domoticz.Debug("Inverter {} found at {}.".format(serial, target['name']))
 
+        inverters = self.state.data.setdefault('inverters', {})
+        targets = self.state.data.setdefault('targets', {})
+        if inverters.get(serial) == identity and targets.get(target['name']) == serial:
+            return
+
+        maxPower = target['maxPower']
+        evCharger = target['evCharger']
+        target['serialNumber'] = serial
+        self.configureTarget(target, identity)
+        if target['evCharger'] and not evCharger:
+            self.syncDevices(target, self.__EV_UNITS)
+        if target['maxPower'] != maxPower:
+            Domoticz.Debug("Maximum inverter power of {} is set to: {} Watt(s)".format(target['name'], target['maxPower']))
+            self.syncDevices(target, [unit for unit in self.__UNITS if unit[0] in self.__POWER_UNITS])
+
+        inverters[serial] = identity
+        targets[target['name']] = serial
+        self.state.save()
+
+    def deviceDefinition(self, target, unit):
+        options = dict(unit[5])
+        if unit[0] in self.__POWER_UNITS:
+            options.update({'ValueMin': '-' + str(target['maxPower']), 'ValueMax': str(target['maxPower'])})
+        return {
+            'Unit': target['offset'] + unit[0],
+            'Name': unit[1] if target['offset'] == 0 else "{} ({})".format(unit[1], target['name']),
+            'Type': unit[2],
+            'Subtype': unit[3],
+            'Switchtype': unit[4],
+            'Options': options,
+            }
+
+    def syncDevices(self, target, units):
+        # Create missing devices and update existing ones whose definition
+        # changed since the last sync, keeping their values. A hash of every
+        # definition is kept in the plugin state, so unchanged devices are
+        # not touched and names or options edited by the user survive.
+        hashes = self.state.data.setdefault('devices', {})
+        for unit in units:
+            definition = self.deviceDefinition(target, unit)
+            digest = "{:08x}".format(zlib.crc32(json.dumps(definition, sort_keys=True).encode('utf-8')))
+            key = str(definition['Unit'])
+            if definition['Unit'] not in Devices:
+                Domoticz.Device(Used=unit[6], **definition).Create()
+            elif hashes.get(key) != digest:
+                self.updateDefinition(Devices[definition['Unit']], definition, key in hashes)
+            hashes[key] = digest
+
+    def updateDefinition(self, device, definition, known):
+        # Devices created by older versions have no hash yet; their name is
+        # left alone, as it may have been set by the user
+        changes = {}
+        if device.Options != definition['Options']:
+            changes['Options'] = definition['Options']
+        if (device.Type, device.SubType, device.SwitchType) != (definition['Type'], definition['Subtype'], definition['Switchtype']):
+            changes.update(Type=definition['Type'], Subtype=definition['Subtype'], Switchtype=definition['Switchtype'])
+        if known and device.Name != definition['Name']:
+            changes['Name'] = definition['Name']
+        if changes:
+            Domoticz.Debug("Updating definition of {}: {}.".format(device.Name, ', '.join(sorted(changes))))
+            device.Update(nValue=device.nValue, sValue=device.sValue, **changes)
+
+    def restoreRemoteControl(self, target):
+        # Remote control settings start from the values of their devices
+        for (unit, key) in self.__RC_UNITS:
+            if target['offset'] + unit in Devices:
+                try:
+                    target['rc'][key] = int(float(Devices[target['offset'] + unit].sValue))
+                except ValueError:
+                    pass
+
+    def updateDevice(self, target, unit, nValue, sValue):
+        self.deviceUpdates.update(target['offset'] + unit, nValue, sValue)
+
+    def setTimedOut(self, target, timedOut):
+        # Mark all devices of the target as (no longer) timed out
+        if target['timedOut'] == timedOut:
+            return
+        target['timedOut'] = timedOut
+        Domoticz.Debug("Devices of {} are {}.".format(target['name'], "timed out" if timedOut else "back online"))
+        units = [unit for (unit, owner) in self.unitTargets.items() if owner is target]
+        self.deviceUpdates.setTimedOut(units, timedOut)
+
+    def getHistory(self, target, key):
+        # Register snapshots of one register group, opened on first use
+        if key not in target['history']:
+            path = None
+            if self.__SETTINGS['historyFile']:
+                name = ''.join(c if c.isalnum() else '_' for c in target['name'])
+                path = os.path.join(str(Parameters.get("HomeFolder", "")), "solax-{}-{}-{}.history".format(Parameters.get("HardwareID", 0), name, key))
+            fields = [field[0] for field in self.registerMaps[key].fields if not field[2].startswith('string')]
+            target['history'][key] = RegisterHistory(fields, self.__SETTINGS['historySize'], path)
+        return target['history'][key]
+
+    def getIntegrator(self, target, key, unit):
+        # Energy integrator, restored from the plugin state on first use; the
+        # total of a device created by an older version is taken over once
+        if key not in target['integrators']:
+            state = self.state.data.get('energy', {}).get(target['name'], {}).get(key)
+            if state is None:
+                energy = self.deviceEnergy(target, unit)
+                if energy is not None:
+                    state = {'energy': energy, 'time': None, 'power': None, 'counter': None}
+            target['integrators'][key] = EnergyIntegrator(self.__SETTINGS['energyGap'], state)
+        return target['integrators'][key]
+
+    def getCounterFilter(self, target):
+        # Counter filter, restored from the plugin state on first use
+        if target['counterFilter'] is None:
+            state = self.state.data.get('counters', {}).get(target['name'])
+            target['counterFilter'] = CounterFilter(self.__SETTINGS['counterMaxPower'], state)
+        return target['counterFilter']
+
+    def filterCounters(self, target, registerMap, values):
+        # Energy counters continue across wraparound and resets; impossible
+        # jumps are replaced by the last good value
+        counters = self.getCounterFilter(target)
+        now = time.time()
+        values = dict(values)
+        for (name, offset, type, scale, unit, fmtValue) in registerMap.fields:
+            if name in self.__COUNTER_FIELDS:
+                values[name] = counters.filter(name, values[name], now, 2 ** 32 * scale, scale)
+        return values
+
+    def getTariffMeter(self, target):
+        # Tariff meter, restored from the plugin state on first use; totals
+        # of a device created by an older version are taken over once
+        if target['tariffMeter'] is None:
+            state = self.state.data.get('tariff', {}).get(target['name'])
+            unit = target['offset'] + 21
+            if state is None and unit in Devices and Devices[unit].sValue:
+                try:
+                    fields = [int(float(value)) for value in Devices[unit].sValue.split(';')]
+                    state = {'imported': fields[0:2], 'exported': fields[2:4]}
+                    Domoticz.Debug("Tariff totals of {} taken over from {}.".format(target['name'], Devices[unit].Name))
+                except ValueError:
+                    Domoticz.Error("Unable to take over tariff totals from '{}', starting from zero.".format(Devices[unit].sValue))
+            meter = TariffMeter(state)
+            if target['offset'] + 39 in Devices:
+                meter.tariff = 1 if Devices[target['offset'] + 39].nValue else 0
+            target['tariffMeter'] = meter
+        return target['tariffMeter']
+
+    def getEVTotal(self, target):
+        # EV Charger energy total, restored from the plugin state on first
+        # use; the total of a device created by an older version is taken
+        # over once
+        if target['evTotal'] is None:
+            state = self.state.data.get('evEnergy', {}).get(target['name'])
+            if state is None:
+                energy = self.deviceEnergy(target, 110)
+                if energy is not None:
+                    state = {'energy': energy}
+            target['evTotal'] = EnergyTotal(state)
+        return target['evTotal']
+
+    def deviceEnergy(self, target, unit):
+        # Energy total of a 'power;energy' device, None when there is none
+        unit = target['offset'] + unit
+        if unit not in Devices or not Devices[unit].sValue:
+            return None
+        try:
+            energy = float(Devices[unit].sValue.split(';')[1])
+            Domoticz.Debug("Energy total of {} taken over from {}.".format(target['name'], Devices[unit].Name))
+            return energy
+        except (IndexError, ValueError):
+            Domoticz.Error("Unable to take over energy total from '{}', starting from zero.".format(Devices[unit].sValue))
+            return None
+
+    def applyTariffSchedule(self, target, meter):
+        # The schedule, when set, overrides the tariff switch
+        schedule = self.__SETTINGS['tariffSchedule']
+        if not schedule:
+            return
+        now = time.localtime()
+        minute = now.tm_hour * 60 + now.tm_min
+        tariff = 0
+        for (start, end) in schedule:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                tariff = 1
+        if tariff != meter.tariff:
+            Domoticz.Debug("Tariff of {} switched to T{} by schedule.".format(target['name'], tariff + 1))
+            meter.tariff = tariff
+        self.updateDevice(target, 39,tariff,"On" if tariff else "Off")
+
+    def createPublisher(self):
+        # Returns None when no output is configured
+        sinks = []
+        try:
+            if self.__SETTINGS['mqtt']:
+                (host, port) = SplitHostPort(self.__SETTINGS['mqtt'], 1883)
+                sinks.append(MqttSink(host, port, self.__SETTINGS['mqttTopic'], "solax-{}".format(Parameters.get("HardwareID", 0))))
+            if self.__SETTINGS['influxUdp']:
+                (host, port) = SplitHostPort(self.__SETTINGS['influxUdp'], 8089)
+                sinks.append(InfluxUdpSink(host, port))
+        except ValueError as err:
+            Domoticz.Error("Ignoring invalid publish setting: {}".format(err))
+        if self.__SETTINGS['influxFile']:
+            path = os.path.join(str(Parameters.get("HomeFolder", "")), "solax-{}.lp".format(Parameters.get("HardwareID", 0)))
+            sinks.append(InfluxFileSink(path))
+        if not sinks:
+            return None
+
+        publisher = Publisher(sinks, self.__SETTINGS['publishQueue'])
+        publisher.start()
+        return publisher
+
+    def publishValues(self, target, group, values):
+        # One record per decoded register group, delivered off the main thread
+        if self.publisher is not None:
+            self.publisher.publish((time.time(), target['name'], group, dict(values)))
+
+    def saveState(self, force=False):
+        # Checkpoint energy and tariff accumulators at most every __STATE_INTERVAL
+        now = time.monotonic()
+        if not force and now - self.stateSaved < self.__STATE_INTERVAL:
+            return
+        self.stateSaved = now
+        energy = self.state.data.setdefault('energy', {})
+        tariff = self.state.data.setdefault('tariff', {})
+        counters = self.state.data.setdefault('counters', {})
+        evEnergy = self.state.data.setdefault('evEnergy', {})
+        for target in self.targets:
+            if target['counterFilter'] is not None:
+                counters[target['name']] = target['counterFilter'].state()
+            for (key, integrator) in target['integrators'].items():
+                energy.setdefault(target['name'], {})[key] = integrator.state()
+            if target['tariffMeter'] is not None:
+                tariff[target['name']] = target['tariffMeter'].state()
+            if target['evTotal'] is not None:
+                evEnergy[target['name']] = target['evTotal'].state()
+        self.state.save()
+    
+    def updateInverter(self, target, register, value, gap=0):
         Domoticz.Debug("Updating Inverter registers.")
         
         payload = int(value)
-        result = self.setRegister(register, payload)
+        result = self.writeRegisters(target, register, [payload], gap)
         if result:
             Domoticz.Debug("Done.")
         else:
             Domoticz.Debug("Failed!")
+        return result
 
-        self.commInProgress = False
-
-    def startRemoteControl(self):
-        while self.commInProgress:
-            time.sleep(1)
-
-        self.commInProgress = True
+    def setEVRunMode(self, target, value, plan):
+        # Runs in the worker; the new run mode is read back right after the
+        # write instead of waiting for the next poll
+        if not self.updateInverter(target, target['evBase'] + 0x0d, value, plan['gap']):
+            return False
+        return self.readRegisterBlocks(target, plan)
+
+    def onEVRunMode(self, target, plan, registers):
+        self.publishDevices(target, 'evHolding', plan, registers, cycle=False)
+        # Charging power follows the run mode, poll it on the next heartbeat
+        target['evNextPoll'] = time.monotonic()
+
+    def triggerRemoteControl(self, target):
+        # Write the remote control block unless the same session is already
+        # running or being written; triggers within rcMinInterval of the last
+        # write are coalesced into one write of the latest settings
+        session = target['remoteControl']
+        payload = session.payload(target['rc'])
+        session.counters['triggers'] += 1
+        if session.isRunning(payload):
+            Domoticz.Debug("Remote control of {} is already running with these settings.".format(target['name']))
+            session.counters['skipped'] += 1
+            return
 
+        worker = target['worker']
+        key = (target['name'], 'remoteControl')
+        # The worker holds off taking the queued write while it is replaced
+        with worker.condition:
+            if session.queued is not None and not worker.isQueued(key):
+                session.running = session.queued
+                session.queued = None
+            if session.running is not None and session.running['payload'] == payload:
+                Domoticz.Debug("Remote control of {} is already being written with these settings.".format(target['name']))
+                if session.queued is not None:
+                    worker.cancel(key)
+                    session.queued = None
+                session.counters['skipped'] += 1
+                return
+
+            now = time.monotonic()
+            if session.queued is not None:
+                session.counters['coalesced'] += 1
+                ready = session.queued['at']
+            else:
+                ready = max(now, session.lastWrite + self.__SETTINGS['rcMinInterval'])
+                if session.running is not None:
+                    ready = max(ready, session.running['at'] + self.__SETTINGS['rcMinInterval'])
+            write = session.queued = {'payload': payload, 'at': ready}
+            worker.submit(self.startRemoteControl, (target, write),
+                callback=lambda result: self.onRemoteControl(target, write, result),
+                priority=ModbusWorker.PRIORITY_WRITE, key=key, delay=ready - now)
+
+    def startRemoteControl(self, target, write):
+        # Runs in the worker; the read back uses the same connection
         Domoticz.Debug("Starting ModBus Remote Control.")
+        write['at'] = time.monotonic()
         
-        builder = BinaryPayloadBuilder(byteorder=Endian.BIG, wordorder=Endian.LITTLE)
-        modes = (0, 1, 2, 3, 7)
-        mode = modes[int(int(self.__RC_SETTINGS['Mode'])/10)]
-        
-        builder.reset()
-        builder.add_16bit_uint(mode)                                            # Remote Control Mode
-        builder.add_16bit_uint(1)                                               # TargetSet type = SET
-        builder.add_32bit_int(int(self.__RC_SETTINGS['PowerTarget']))           # Target Active Power
-        builder.add_32bit_int(0)                                                # Target Reactive Power
-        builder.add_16bit_uint(int(self.__RC_SETTINGS['DurationTime']))         # Time of Duration
-        builder.add_16bit_uint(int(self.__RC_SETTINGS['SOCTarget']))            # Target SOC
-        builder.add_32bit_uint(int(self.__RC_SETTINGS['EnergyTarget']))         # Target Energy
-        builder.add_32bit_int(int(self.__RC_SETTINGS['ChargerPower']))          # Charge / Discharge Power
-        builder.add_16bit_uint(int(self.__RC_SETTINGS['TimeOut']))              # Remote Control Timeout
-
-        payload = builder.to_registers()
-        result = self.setMultipleRegisters(0x007c, payload)
+        result = self.writeRegisters(target, 0x007c, write['payload'])
         if result:
             Domoticz.Debug("Done.")
         else:
             Domoticz.Debug("Failed!")
-        
-        self.commInProgress = False
+            return None
+        return self.readRegisterBlocks(target, self.rcPlan)
+
+    def onRemoteControl(self, target, write, registers):
+        session = target['remoteControl']
+        if session.running is write:
+            session.running = None
+        elif session.queued is write:
+            session.queued = None
+        session.lastWrite = time.monotonic()
+        payload = write['payload']
+        values = self.rcPlan['map'].decode(registers) if registers else None
+        if values is None:
+            Domoticz.Error("Remote control write to {} failed.".format(target['name']))
+            session.acknowledged = None
+            return
 
-    def updateDevices(self):
-        while self.commInProgress:
-            time.sleep(1)
+        if session.confirm(payload, values):
+            Domoticz.Debug("Remote control write to {} confirmed.".format(target['name']))
+        else:
+            Domoticz.Error("Remote control write to {} not confirmed by read back: {}".format(target['name'], values))
+        self.updateMappedDevices(target, self.rcPlan['map'], values)
+        self.updateRemoteControlDevices(target, values)
+        self.deviceUpdates.flush()
+        Domoticz.Debug("Remote control: {}".format(session.counters))
+
+    def updateDevices(self, target):
+        # Queue one poll of all target devices; results are published by
+        # onHeartbeat. Each register group is a separate job, so queued writes
+        # can run in between, and a newer poll supersedes reads still queued.
+        self.updateReadPlans(target)
+        target['pollStarted'] = time.monotonic()
+        target['nextPoll'] = target['pollStarted'] + target['interval']
+
+        # Nothing is read from a host which is down until its next probe
+        if not target['link'].available():
+            Domoticz.Debug("Skipping poll of {}, ModBus link is down.".format(target['name']))
+            self.setTimedOut(target, True)
+            self.deviceUpdates.flush()
+            return
 
-        self.commInProgress = True
+        # An EV Charger behind an inverter has its own poller
+        if target['kind'] == 'inverter':
+            reads = ['inverter']
+        else:
+            reads = ['evInput', 'evHolding']
+
+        for key in reads:
+            plan = target['readPlans'][key]
+            if not plan['blocks']:
+                continue
+            target['pendingReads'].add(key)
+            target['worker'].submit(self.readRegisterBlocks, (target, plan),
+                callback=lambda result, key=key, plan=plan: self.publishDevices(target, key, plan, result),
+                key=(target['name'], key))
+
+    def samplePower(self, target):
+        # Runs in the worker every sampleInterval ms and queues itself again;
+        # the samples wait in the target's sampler until the next poll
+        started = time.monotonic()
+        if target['link'].available():
+            registers = self.readRegisterBlocks(target, self.samplePlan)
+            values = self.samplePlan['map'].decode(registers) if registers else None
+            if values is not None:
+                target['sampler'].add(values)
+        target['worker'].submit(self.samplePower, (target,), key=(target['name'], 'sample'),
+            delay=max(0, started + self.__SETTINGS['sampleInterval'] / 1000 - time.monotonic()))
+
+    def updateEVCharger(self, target):
+        # Poll of the EV Charger mapped behind an inverter, every evInterval
+        # seconds. Both groups are queued at once; the worker keeps evGap
+        # between their transactions and any other traffic on the link.
+        self.updateReadPlans(target)
+        target['evNextPoll'] = time.monotonic() + self.__SETTINGS['evInterval']
+        if not target['link'].available():
+            return
+
+        for key in ('evInput', 'evHolding'):
+            plan = target['readPlans'][key]
+            if not plan['blocks']:
+                continue
+            target['worker'].submit(self.readRegisterBlocks, (target, plan),
+                callback=lambda result, key=key, plan=plan: self.publishDevices(target, key, plan, result, cycle=False),
+                key=(target['name'], key))
+
+    def publishDevices(self, target, key, plan, registers, cycle=True):
+        # cycle is False for reads outside of the target poll (EV Charger
+        # poller, read back after a write), which do not complete it
+        if not cycle:
+            self.publishRegisters(target, key, plan, registers)
+            self.deviceUpdates.flush()
+            return
 
-        # Inverter data
-        Domoticz.Debug("Updating devices from Inverter Input Registers.")
-        inputRegisters = self.getInputRegisters(0, 290, 50)
-        if inputRegisters:
+        target['pendingReads'].discard(key)
+        self.publishRegisters(target, key, plan, registers)
+
+        if not target['pendingReads']:
+            if target['kind'] == 'inverter':
+                Domoticz.Debug("Updating devices from Local array.")
+                self.updateLocalDevices(target)
+            self.recordCycle(target)
+        started = time.perf_counter()
+        self.deviceUpdates.flush()
+        self.metrics.observe('flush_seconds', (), time.perf_counter() - started)
+
+        if not target['pendingReads']:
+            self.saveState()
+            self.exportMetrics()
+
+            Domoticz.Debug("ModBus connection: {}".format(target['link'].stats()))
+            Domoticz.Debug("ModBus scheduler: {}".format(target['worker'].stats()))
+            Domoticz.Debug("Device updates: {}".format(self.deviceUpdates.stats()))
+
+    def publishRegisters(self, target, key, plan, registers):
+        updates = {
+            # key: (name, update function)
+            'inverter': ("Inverter Input Registers", self.updateInverterModBusDevices),
+            'evInput': ("EV Charger Input Registers", self.updateEVChargerModBusDevicesInput),
+            'evHolding': ("EV Charger Holding Registers", self.updateEVChargerModBusDevicesHolding),
+            }
+        (name, update) = updates[key]
+        Domoticz.Debug("Updating devices from {} of {}.".format(name, target['name']))
+        if registers:
             Domoticz.Debug("Done.")
-            self.updateInverterModBusDevices(inputRegisters)
+            self.setTimedOut(target, False)
+            started = time.perf_counter()
+            update(target, plan['map'], registers)
+            self.metrics.observe('decode_seconds', (('target', target['name']), ('group', key)), time.perf_counter() - started)
         else:
             Domoticz.Debug("Failed!")
-        
-        # EV Charger data
-        Domoticz.Debug("Updating devices from EV Charger Input Registers.")
-        if self.__SETTINGS['evCharger']:
-            time.sleep(2)
-            inputRegisters = self.getInputRegisters(0x1000, 30, 30)
-            if inputRegisters:
-                Domoticz.Debug("Done.")
-                self.updateEVChargerModBusDevicesInput(inputRegisters)
-            else:
-                Domoticz.Debug("Failed!")
-
-        Domoticz.Debug("Updating devices from EV Charger Holding Registers.")
-        if self.__SETTINGS['evCharger']:
-            time.sleep(5)
-            holdingRegisters = self.getHoldingRegisters(0x1000, 50, 50)
-            if holdingRegisters:
-                Domoticz.Debug("Done.")
-                self.updateEVChargerModBusDevicesHolding(holdingRegisters)
-            else:
-                Domoticz.Debug("Failed!")
-
-        Domoticz.Debug("Updating devices from Local array.")
-        self.updateLocalDevices()
-
-        self.commInProgress = False
-
-    def updateLocalDevices(self):
-        val = self.__RC_SETTINGS['PowerTarget']
-        UpdateDevice(60,0,"{}".format(val))
-        val = self.__RC_SETTINGS['EnergyTarget']
-        UpdateDevice(61,0,"{}".format(val))
-        val = self.__RC_SETTINGS['SOCTarget']
-        UpdateDevice(62,0,"{}".format(val))
-        val = self.__RC_SETTINGS['ChargerPower']
-        UpdateDevice(63,0,"{}".format(val))
-        val = self.__RC_SETTINGS['DurationTime']
-        UpdateDevice(64,0,"{}".format(val))
-        val = self.__RC_SETTINGS['TimeOut']
-        UpdateDevice(65,0,"{}".format(val))
-        val = self.__RC_SETTINGS['Mode']
-        UpdateDevice(66,0,"{}".format(val))
+            if target['link'].isOpen():
+                self.setTimedOut(target, True)
+
+    def recordCycle(self, target):
+        # Per cycle figures of a completed poll, published to the diagnostic
+        # devices when enabled
+        labels = (('target', target['name']),)
+        cycle = time.monotonic() - target['pollStarted']
+        self.metrics.observe('cycle_seconds', labels, cycle)
+        for name in ('requests', 'bytes', 'failures', 'retries'):
+            total = self.metrics.value('modbus_{}_total'.format(name), labels)
+            self.metrics.setGauge('cycle_' + name, labels, total - target['cycleMarks'].get(name, 0))
+            target['cycleMarks'][name] = total
+        units = [unit for (unit, owner) in self.unitTargets.items() if owner is target]
+        for (index, name) in enumerate(('writes', 'skipped_writes')):
+            total = sum(self.deviceUpdates.unitCounts.get(unit, (0, 0))[index] for unit in units)
+            self.metrics.setGauge('cycle_' + name, labels, total - target['cycleMarks'].get(name, 0))
+            target['cycleMarks'][name] = total
+
+        if not self.__SETTINGS['diagnostics']:
+            return
+        requests = self.metrics.value('cycle_requests', labels)
+        failures = self.metrics.value('cycle_failures', labels)
+        skipped = self.metrics.value('cycle_skipped_writes', labels)
+        writes = self.metrics.value('cycle_writes', labels) + skipped
+        self.updateDevice(target, 70,0,"{}".format(round(cycle * 1000)))
+        self.updateDevice(target, 71,0,"{}".format(requests))
+        self.updateDevice(target, 72,0,"{}".format(self.metrics.value('cycle_bytes', labels)))
+        self.updateDevice(target, 73,0,"{}".format(round(failures * 100 / requests, 1) if requests else 0))
+        self.updateDevice(target, 74,0,"{}".format(self.metrics.value('cycle_retries', labels)))
+        self.updateDevice(target, 75,0,"{}".format(round(skipped * 100 / writes, 1) if writes else 0))
+
+    def exportMetrics(self, force=False):
+        # Metrics as JSON and Prometheus text (node exporter textfile format)
+        if not self.__SETTINGS['metricsFile']:
+            return
+        now = time.monotonic()
+        if not force and now - self.metricsExported < self.__METRICS_INTERVAL:
+            return
+        self.metricsExported = now
+
+        for ((address, port), link) in self.links.items():
+            labels = (('host', "{}:{}".format(address, port)),)
+            for name in ('connects', 'reconnects', 'failures', 'drops', 'retries', 'errors', 'rejected', 'trips', 'gaps'):
+                self.metrics.setCounter('link_{}_total'.format(name), labels, link.counters[name])
+            self.metrics.setGauge('link_breaker_open', labels, 1 if link.isOpen() else 0)
+            stats = self.workers[(address, port)].stats()
+            self.metrics.setGauge('worker_queue_depth', labels, stats['depth'])
+            for kind in ('read', 'write'):
+                self.metrics.setCounter('worker_jobs_total', labels + (('kind', kind),), stats[kind + 's'])
+                self.metrics.setGauge('worker_wait_seconds_avg', labels + (('kind', kind),), stats[kind + 'WaitAvg'])
+                self.metrics.setGauge('worker_wait_seconds_max', labels + (('kind', kind),), stats[kind + 'WaitMax'])
+        for name in ('issued', 'skipped'):
+            self.metrics.setCounter('device_writes_total', (('result', name),), self.deviceUpdates.counters[name])
+        for target in self.targets:
+            if target['counterFilter'] is not None:
+                for (name, count) in target['counterFilter'].counts.items():
+                    self.metrics.setCounter('counter_values_total', (('target', target['name']), ('result', name)), count)
+            if target['sampler'] is not None:
+                for name in ('samples', 'overwritten'):
+                    self.metrics.setCounter('power_samples_total', (('target', target['name']), ('result', name)), target['sampler'].counters[name])
+        if self.publisher is not None:
+            for name in ('queued', 'published', 'dropped', 'failed'):
+                self.metrics.setCounter('publish_records_total', (('result', name),), self.publisher.counters[name])
+            self.metrics.setGauge('publish_queue_depth', (), self.publisher.records.qsize())
+
+        path = os.path.join(str(Parameters.get("HomeFolder", "")), "solax-{}-metrics".format(Parameters.get("HardwareID", 0)))
+        try:
+            WriteFileAtomically(path + '.json', json.dumps(self.metrics.snapshot()))
+            WriteFileAtomically(path + '.prom', self.metrics.prometheus('solax'))
+        except OSError as err:
+            Domoticz.Error("Unable to export metrics to {}: {}".format(path, err))
+
+    def updateReadPlans(self, target):
+        # Re-plan only when devices were added, removed or (un)marked as used
+        units = [unit for (unit, owner) in self.unitTargets.items() if owner is target and unit in Devices]
+        signature = tuple((unit, Devices[unit].Used) for unit in sorted(units))
+        if signature == target['planSignature']:
+            return
+        target['planSignature'] = signature
+        target['activeUnits'] = {unit - target['offset'] for unit in units if Devices[unit].Used}
+        active = target['activeUnits']
+
+        evGap = self.__SETTINGS['evGap'] / 1000
+        plans = [
+            # key, base address, holding, register table, derived devices, gap, bridge
+            ['inverter', 0, False, self.__INVERTER_REGISTERS, self.__INVERTER_DERIVED, 0, False],
+            ['evInput', target['evBase'], False, self.__EV_INPUT_REGISTERS, self.__EV_INPUT_DERIVED, evGap, True],
+            ['evHolding', target['evBase'], True, self.__EV_HOLDING_REGISTERS, self.__EV_HOLDING_DERIVED, evGap, True],
+        ]
+        for (key, base, holding, registers, derived, gap, bridge) in plans:
+            names = {field[0] for field in registers if field[4] in active}
+            if key == 'inverter' and self.__SETTINGS['adaptivePolling']:
+                names.update(self.__ADAPTIVE_FIELDS)
+            for (unit, fields) in derived:
+                if unit in active:
+                    names.update(fields)
+            registerMap = self.registerMaps[key].subset(names)
+            target['readPlans'][key] = self.planRegisterReads("{} {}".format(target['name'], key), base, holding, registerMap, gap, bridge)
+
+    def adaptPollInterval(self, target, values):
+        # Poll fast while power swings or remote control is active, back off
+        # while values are steady and slow down to pollMax when idle
+        if not self.__SETTINGS['adaptivePolling']:
+            return
+        base = self.__SETTINGS['updateInterval']
+        low = min(self.__SETTINGS['pollMin'], base)
+        high = max(self.__SETTINGS['pollMax'], base)
+
+        # The interval stays at the base until there is a sample to compare to
+        history = self.getHistory(target, 'inverter')
+        change = 0
+        for name in ('inverterPower', 'batteryPower', 'gridPower'):
+            last = history.last(name)
+            if last is None:
+                return
+            change = max(change, abs(values[name] - last))
+        change = int(change)
+
+        if values['rcMode'] != 0 or change >= self.__SETTINGS['pollVolatility']:
+            interval = low
+        elif (values['runMode'] in self.__IDLE_RUN_MODES
+                and values['pv1Power'] + values['pv2Power'] == 0
+                and abs(values['batteryPower']) < self.__SETTINGS['pollSteady']):
+            interval = high
+        elif change < self.__SETTINGS['pollSteady']:
+            interval = min(high, max(base, int(target['interval'] * 1.5)))
+        else:
+            interval = base
+
+        if interval != target['interval']:
+            Domoticz.Debug("Poll interval of {} changed to {}s (power change {} W).".format(target['name'], interval, change))
+            target['interval'] = interval
+            # A shorter interval applies to the poll already scheduled
+            target['nextPoll'] = min(target['nextPoll'], target['pollStarted'] + interval)
+
+    def planRegisterReads(self, key, base, holding, registerMap, gap=0, bridge=False):
+        # A bridged plan (EV Charger) merges its registers into as few
+        # requests as the block size allows, bridging holes of any size,
+        # because each request holds the host link for the gap. The gap only
+        # sets the idle time before each request.
+        maxGap = self.__SETTINGS['readBlock'] if bridge else self.__SETTINGS['readGap']
+        blocks = registerMap.planBlocks(maxGap, self.__SETTINGS['readBlock'])
+        Domoticz.Debug("Read plan '{}': {} register(s) in {} request(s) {}.".format(
+            key, sum(count for (start, count) in blocks), len(blocks),
+            ["0x{:04x}+{}".format(base + start, count) for (start, count) in blocks]))
+        return {'base': base, 'holding': holding, 'map': registerMap, 'blocks': blocks, 'gap': gap}
+
+    def readRegisterBlocks(self, target, plan):
+        return self.readRegisters(target, plan['holding'], plan['base'], plan['blocks'], plan['map'].length, plan['gap'])
+
+    def updateLocalDevices(self, target):
+        rc = target['rc']
+        for (unit, key) in self.__RC_UNITS:
+            self.updateDevice(target, unit,0,"{}".format(rc[key]))
+
+    def updateMappedDevices(self, target, registerMap, values):
+        for (unit, name, fmt) in registerMap.units:
+            if unit in target['activeUnits']:
+                self.updateDevice(target, unit,0,fmt.format(values[name]))
 
     # EV Charger devices
-    def updateEVChargerModBusDevicesInput(self, registers):
-        decoder = BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE)
-        
-        # EV Charger Power / Energy
-        decoder.reset()
-        decoder.skip_bytes(0x000b * 2)
-        valP = decoder.decode_16bit_uint()
-        decoder.reset()
-        decoder.skip_bytes(0x000f * 2)
-        newEVEnergy = decoder.decode_32bit_uint() * 100
-
-        if newEVEnergy < self.lastEVEnergy:
-            self.lastEVEnergy = 0
+    def updateEVChargerModBusDevicesInput(self, target, registerMap, registers):
+        values = registerMap.decode(registers)
+        if values is None:
+            Domoticz.Debug("Short EV Charger input register read, skipping.")
+            return
+        values = self.filterCounters(target, registerMap, values)
+        self.updateMappedDevices(target, registerMap, values)
+        active = target['activeUnits']
         
-        try:
-            [oldP, oldE] = Devices[110].sValue.split(';')
-        except:
-            [oldP, oldE] = [0, 0]
-
-        valE = float(oldE) + newEVEnergy - self.lastEVEnergy
-        self.lastEVEnergy = newEVEnergy
-        UpdateDevice(100,0,"{}".format(valP))
-        UpdateDevice(110,0,"{};{}".format(valP, valE))
+        # EV Charger Energy
+        # The charger counter, kept monotonic by the counter filter, adds its
+        # change since the last poll to the persisted total
+        if 110 in active:
+            total = self.getEVTotal(target)
+            total.add(values['evEnergy'])
+            self.updateDevice(target, 110,0,"{};{}".format(values['evPower'], round(total.energy, 3)))
 
         # EV Charger state
-        decoder.reset()
-        decoder.skip_bytes(0x001d * 2)
-        val = decoder.decode_16bit_uint()
-        if 0 <= val <= 10:
-            UpdateDevice(120,0,"{}".format(self.__EV_STATE[val]))
-        else:
-            UpdateDevice(120,0,"Unknown state")
+        if 120 in active:
+            val = values['evState']
+            if 0 <= val <= 10:
+                self.updateDevice(target, 120,0,"{}".format(self.__EV_STATE[val]))
+            else:
+                self.updateDevice(target, 120,0,"Unknown state")
 
-        # EV Charger Temperature
-        decoder.reset()
-        decoder.skip_bytes(0x001c * 2)
-        val = decoder.decode_16bit_int()
-        UpdateDevice(130,0,"{}".format(val))
+        self.publishValues(target, 'evInput', values)
     
-    def updateEVChargerModBusDevicesHolding(self, registers):
-        decoder = BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE)
-        
+    def updateEVChargerModBusDevicesHolding(self, target, registerMap, registers):
+        values = registerMap.decode(registers)
+        if values is None:
+            Domoticz.Debug("Short EV Charger holding register read, skipping.")
+            return
+
         # EV Charger Run Mode
-        decoder.reset()
-        decoder.skip_bytes(0x000d * 2)
-        val = decoder.decode_16bit_uint()
-        UpdateDevice(121,0,"{}".format(val * 10))
+        if 121 in target['activeUnits']:
+            self.updateDevice(target, 121,0,"{}".format(values['evRunMode'] * 10))
+
+        self.publishValues(target, 'evHolding', values)
     
         # EV Charger Max Current
-        #decoder.reset()
-        #decoder.skip_bytes(0x0028 * 2)
-        #val = decoder.decode_16bit_uint()
-        #UpdateDevice(131,0,"{}".format(val / 100))
+        #self.updateDevice(target, 131,0,"{}".format(values['evMaxCurrent'] / 100))
     
     # Inverter devices
-    def updateInverterModBusDevices(self, registers):
-        decoder = BinaryPayloadDecoder.fromRegisters(registers, byteorder=Endian.BIG, wordorder=Endian.LITTLE)
-
-        # Output Power / Energy
-        decoder.reset()
-        decoder.skip_bytes(0x0002 * 2)
-        valP = decoder.decode_16bit_int()
-        decoder.reset()
-        decoder.skip_bytes(0x0052 * 2)
-        valE = decoder.decode_32bit_uint() * 100
-        UpdateDevice(1,0,"{}".format(valP))
-        UpdateDevice(15,0,"{};{}".format(valP, valE))
-        
-        # PV1 Power
-        decoder.reset()
-        decoder.skip_bytes(0x000a * 2)
-        valP1 = decoder.decode_16bit_uint()
-        UpdateDevice(2,0,"{}".format(valP1))
-        
-        # PV2 Power
-        decoder.reset()
-        decoder.skip_bytes(0x000b * 2)
-        valP2 = decoder.decode_16bit_uint()
-        UpdateDevice(3,0,"{}".format(valP2))
+    def updateInverterModBusDevices(self, target, registerMap, registers):
+        values = registerMap.decode(registers)
+        if values is None:
+            Domoticz.Debug("Short Inverter input register read, skipping.")
+            return
+        raw = values
+        values = self.filterCounters(target, registerMap, values)
+        active = target['activeUnits']
+        decoded = values
+
+        self.adaptPollInterval(target, values)
+
+        # With fast sampling, devices show the mean power since the last poll
+        if target['sampler'] is not None:
+            (count, aggregates) = target['sampler'].take()
+            if count:
+                values = dict(values, **{name: round(mean) for (name, (low, high, mean, last)) in aggregates.items()})
+                samples = {'samples': count}
+                for (name, aggregate) in aggregates.items():
+                    samples.update(zip((name + 'Min', name + 'Max', name + 'Mean', name + 'Last'), aggregate))
+                self.publishValues(target, 'samples', samples)
+
+        # Power, temperature, capacity and remote control values published as is
+        self.updateMappedDevices(target, registerMap, values)
+
+        # Output Energy
+        if 15 in active:
+            self.updateDevice(target, 15,0,"{};{}".format(values['inverterPower'], values['inverterEnergy']))
 
         # Total PV Power / Energy
-        valP = valP1 + valP2
-        decoder.reset()
-        decoder.skip_bytes(0x0094 * 2)
-        valE = decoder.decode_32bit_uint() * 100
-        UpdateDevice(4,0,"{}".format(valP))
-        UpdateDevice(10,0,"{};{}".format(valP, valE))
-
-        # Battery Power / Energy
-        decoder.reset()
-        decoder.skip_bytes(0x0016 * 2)
-        valP = decoder.decode_16bit_int()
-        decoder.reset()
-        decoder.skip_bytes(0x0021 * 2)
-        valE1 = decoder.decode_32bit_uint() * 100
-        decoder.reset()
-        decoder.skip_bytes(0x001d * 2)
-        valE2 = decoder.decode_32bit_uint() * 100
-        UpdateDevice(5,0,"{}".format(valP))
-        if valP >= 0:
-            valP1 = valP
-            valP2 = 0
-        elif valP < 0:
-            valP1 = 0
-            valP2 = abs(valP)
-        UpdateDevice(11,0,"{};{}".format(valP1, valE1))
-        UpdateDevice(12,0,"{};{}".format(valP2, valE2))
-
-        # Grid Power / Energy
-        decoder.reset()
-        decoder.skip_bytes(0x0046 * 2)
-        valP = decoder.decode_32bit_int()
-        valE1 = decoder.decode_32bit_uint() * 10
-        valE2 = decoder.decode_32bit_uint() * 10
-        UpdateDevice(6,0,"{}".format(valP))
-
-        if valP >= 0:
-            valP1 = valP
-            valP2 = 0
-        elif valP < 0:
-            valP1 = 0
-            valP2 = abs(valP)
-        
-        try:
-            [oldP1, oldE1] = Devices[13].sValue.split(';')
-        except:
-            [oldP1, oldE1] = [0, 0]
-
-        try:
-            [oldP2, oldE2] = Devices[14].sValue.split(';')
-        except:
-            [oldP2, oldE2] = [0, 0]
-
-        try:
-            [oldE2T1, oldE2T2, oldE1T1, oldE1T2, oldP1, oldP2] = Devices[21].sValue.split(';')
-        except:
-            [oldE2T1, oldE2T2, oldE1T1, oldE1T2, oldP1, oldP2] = [0, 0, 0, 0, 0, 0]
-
-        UpdateDevice(13,0,"{};{}".format(valP1, valE1))
-        UpdateDevice(14,0,"{};{}".format(valP2, valE2))
-        UpdateDevice(20,0,"{};{};{};{};{};{}".format(valE2, 0, valE1, 0, valP2, valP1))
-
-        if Devices[39].sValue == 'On':
-            valE1 = int(oldE1T2) + valE1 - int(oldE1) 
-            valE2 = int(oldE2T2) + valE2 - int(oldE2) 
-            UpdateDevice(21,0,"{};{};{};{};{};{}".format(oldE2T1, valE2, oldE1T1 , valE1, valP2, valP1))
-        else:
-            valE1 = int(oldE1T1) + valE1 - int(oldE1) 
-            valE2 = int(oldE2T1) + valE2 - int(oldE2) 
-            UpdateDevice(21,0,"{};{};{};{};{};{}".format(valE2, oldE2T2, valE1, oldE1T2, valP2, valP1))
-
+        if active & {4, 10}:
+            valP = values['pv1Power'] + values['pv2Power']
+            if 4 in active:
+                self.updateDevice(target, 4,0,"{}".format(valP))
+            if 10 in active:
+                self.updateDevice(target, 10,0,"{};{}".format(valP, values['pvEnergy']))
+
+        # Battery Energy
+        if active & {11, 12}:
+            valP = values['batteryPower']
+            if valP >= 0:
+                valP1 = valP
+                valP2 = 0
+            elif valP < 0:
+                valP1 = 0
+                valP2 = abs(valP)
+            if 11 in active:
+                self.updateDevice(target, 11,0,"{};{}".format(valP1, values['batteryInEnergy']))
+            if 12 in active:
+                self.updateDevice(target, 12,0,"{};{}".format(valP2, values['batteryOutEnergy']))
+
+        # Grid Energy
+        if active & {13, 14, 20, 21}:
+            valP = values['gridPower']
+            valE1 = values['gridExportEnergy']
+            valE2 = values['gridImportEnergy']
+
+            if valP >= 0:
+                valP1 = valP
+                valP2 = 0
+            elif valP < 0:
+                valP1 = 0
+                valP2 = abs(valP)
+            
+            if 13 in active:
+                self.updateDevice(target, 13,0,"{};{}".format(valP1, valE1))
+            if 14 in active:
+                self.updateDevice(target, 14,0,"{};{}".format(valP2, valE2))
+            if 20 in active:
+                self.updateDevice(target, 20,0,"{};{};{};{};{};{}".format(valE2, 0, valE1, 0, valP2, valP1))
+
+            if 21 in active:
+                meter = self.getTariffMeter(target)
+                self.applyTariffSchedule(target, meter)
+                meter.add(valE2, valE1)
+                self.updateDevice(target, 21,0,"{};{};{};{};{};{}".format(*meter.imported, *meter.exported, valP2, valP1))
 
         # Local Power / Energy Consumption
-        # Energy is calculated by Domoticz due to lack of information from inverter
-        decoder.reset()
-        decoder.skip_bytes(0x0046 * 2)
-        valP1 = decoder.decode_32bit_int()
-        decoder.reset()
-        decoder.skip_bytes(0x0002 * 2)
-        valP2 = decoder.decode_16bit_int()
-        valP = valP2 - valP1
-        if valP < 0:
-            valP = 0
-        UpdateDevice(7,0,"{}".format(valP))
-        UpdateDevice(16,0,"{};{}".format(valP, 0))
-
-        # Off-Grid Power / Energy
-        decoder.reset()
-        decoder.skip_bytes(0x004e * 2)
-        valP = decoder.decode_16bit_int()
-        decoder.reset()
-        decoder.skip_bytes(0x008e * 2)
-        valE = decoder.decode_32bit_int() * 100
-        UpdateDevice(8,0,"{}".format(valP))
-        UpdateDevice(17,0,"{};{}".format(valP, valE))
-        
-        # Battery Capacity
-        decoder.reset()
-        decoder.skip_bytes(0x001c * 2)
-        val = decoder.decode_16bit_uint()
-        UpdateDevice(30,0,"{}".format(val))
-
-        # Inverter Temperature
-        decoder.reset()
-        decoder.skip_bytes(0x0008 * 2)
-        val = decoder.decode_16bit_uint()
-        UpdateDevice(31,0,"{}".format(val))
-
-        # Battery Temperature
-        decoder.reset()
-        decoder.skip_bytes(0x0018 * 2)
-        val = decoder.decode_16bit_uint()
-        UpdateDevice(32,0,"{}".format(val))
+        # Energy is integrated from power, inverter and grid counters bridge gaps
+        if active & {7, 16}:
+            valP = values['inverterPower'] - values['gridPower']
+            if valP < 0:
+                valP = 0
+            if 7 in active:
+                self.updateDevice(target, 7,0,"{}".format(valP))
+            if 16 in active:
+                integrator = self.getIntegrator(target, 'localEnergy', 16)
+                integrator.add(time.time(), valP, values['inverterEnergy'] - values['gridExportEnergy'] + values['gridImportEnergy'])
+                self.updateDevice(target, 16,0,"{};{}".format(valP, round(integrator.energy)))
+
+        # Off-Grid Energy
+        if 17 in active:
+            self.updateDevice(target, 17,0,"{};{}".format(values['offGridPower'], values['offGridEnergy']))
 
         # Run Mode
-        decoder.reset()
-        decoder.skip_bytes(0x0009 * 2)
-        val = decoder.decode_16bit_uint()
-        if 0 <= val <= 10:
-            UpdateDevice(33,0,"{}".format(self.__RUN_MODES[val]))
-        else:
-            UpdateDevice(33,0,"Unknown mode")
+        if 33 in active:
+            val = values['runMode']
+            if 0 <= val <= 10:
+                self.updateDevice(target, 33,0,"{}".format(self.__RUN_MODES[val]))
+            else:
+                self.updateDevice(target, 33,0,"Unknown mode")
         
         # Grid status
-        decoder.reset()
-        decoder.skip_bytes(0x001a * 2)
-        val = decoder.decode_16bit_uint()
-        if val > 0:
-            UpdateDevice(34,0,"Off")
-        else:
-            UpdateDevice(34,1,"On")
-
-        # Remote control - Target Power
-        decoder.reset()
-        decoder.skip_bytes(0x0102 * 2)
-        valP = decoder.decode_32bit_int()
-        UpdateDevice(50,0,"{}".format(valP))
-
-        # Remote control - Target Energy
-        decoder.reset()
-        decoder.skip_bytes(0x0112 * 2)
-        valE = decoder.decode_32bit_int()
-        UpdateDevice(51,0,"{}".format(valE))
-
-        # Remote control - Target SOC
-        decoder.reset()
-        decoder.skip_bytes(0x011b * 2)
-        val = decoder.decode_16bit_uint()
-        UpdateDevice(52,0,"{}".format(val))
-        
-        # Remote control - Charge / Discharge Power
-        decoder.reset()
-        decoder.skip_bytes(0x0114 * 2)
-        valP = decoder.decode_32bit_int()
-        UpdateDevice(53,0,"{}".format(valP))
+        if 34 in active:
+            if values['gridStatus'] > 0:
+                self.updateDevice(target, 34,0,"Off")
+            else:
+                self.updateDevice(target, 34,1,"On")
+
+        self.updateRemoteControlDevices(target, values)
+
+        # The history of raw register values is only kept for the adaptive
+        # poll interval, its only reader
+        if self.__SETTINGS['adaptivePolling']:
+            self.getHistory(target, 'inverter').append(time.time(), raw)
+        self.publishValues(target, 'inverter', decoded)
+
+    def updateRemoteControlDevices(self, target, values):
+        active = target['activeUnits']
+        if 'rcMode' in values:
+            target['remoteControl'].mode = values['rcMode']
 
         # Remote Control Mode
-        decoder.reset()
-        decoder.skip_bytes(0x0100 * 2)
-        val = decoder.decode_16bit_uint()
-        if 0 <= val <= 10:
-            UpdateDevice(54,0,"{}".format(self.__REMOTECONTROL_MODES[val]))
-        else:
-            UpdateDevice(54,0,"Unknown mode")
+        if 54 in active:
+            val = values['rcMode']
+            if 0 <= val < len(self.__REMOTECONTROL_MODES):
+                self.updateDevice(target, 54,0,"{}".format(self.__REMOTECONTROL_MODES[val]))
+            else:
+                self.updateDevice(target, 54,0,"Unknown mode")
         
         # Remote Control Status
-        decoder.reset()
-        decoder.skip_bytes(0x0101 * 2)
-        val = decoder.decode_16bit_uint()
-        if val > 0:
-            UpdateDevice(55,1,"On")
+        if 55 in active:
+            if values['rcTimeoutActive'] > 0:
+                self.updateDevice(target, 55,1,"On")
+            else:
+                self.updateDevice(target, 55,0,"Off")
+
+    # ModBus I/O
+    # ==========
+
+    def transact(self, target, requests, gap=0):
+        # (request, size) transactions on the target's link, timed and
+        # counted; size is the ModBus TCP traffic of the request and response
+        # (bytes) and gap the idle time (s) the link needs before a request.
+        # Concurrent on an async link; returns the responses in order, None
+        # for failed or skipped ones. Each host has a single worker, so the
+        # link's retries during the call belong to this target.
+        link = target['link']
+        retries = link.counters['retries']
+        results = link.executeMany([request for (request, size) in requests], gap)
+        for ((request, size), (result, duration)) in zip(requests, results):
+            if duration is not None:
+                self.metrics.recordRequest(target['name'], duration, size, result is not None)
+        self.metrics.count('modbus_retries_total', (('target', target['name']),), link.counters['retries'] - retries)
+        return [result for (result, duration) in results]
+
+    def readRegisters(self, target, holding, base, blocks, length, gap=0):
+        # Reads the (start, count) blocks at base + start into one buffer of
+        # length registers, filled in place and decoded from as is. Returns
+        # the buffer, or False when a block failed or came back short.
+        unitId = target['unitId']
+        if holding:
+            read = lambda client, address, count: client.read_holding_registers(address=address, count=count, slave=unitId)
         else:
-            UpdateDevice(55,0,"Off")
-
-        # Remote control - Duration Time
-        decoder.reset()
-        decoder.skip_bytes(0x011a * 2)
-        val = decoder.decode_16bit_uint()
-        UpdateDevice(56,0,"{}".format(val))
-
-        # Remote control - TimeOut
-        decoder.reset()
-        decoder.skip_bytes(0x011e * 2)
-        val = decoder.decode_16bit_uint()
-        UpdateDevice(57,0,"{}".format(val))
-
-    def getInputRegisters(self, start=0, length=100, step=10):
-        Domoticz.Debug("Connecting to: {}:{}, unitID: {}".format(self.__SETTINGS['address'], self.__SETTINGS['port'], self.__SETTINGS['unitId']))
-        (cycles, res) = divmod(length, step)
+            read = lambda client, address, count: client.read_input_registers(address=address, count=count, slave=unitId)
+        requests = [(lambda client, address=base + start, count=count: read(client, address, count), 21 + 2 * count)
+            for (start, count) in blocks]
+
+        registers = array('H', bytes(length * 2))
+        for ((start, count), result) in zip(blocks, self.transact(target, requests, gap)):
+            words = getattr(result, 'registers', None)
+            if words is None or len(words) != count:
+                Domoticz.Debug("Unable to read {} registers 0x{:04x}+{} of {}: {}".format(
+                    'holding' if holding else 'input', base + start, count, target['name'], result))
+                return False
+            registers[start:start + count] = array('H', words)
+        return registers
+
+    def writeRegisters(self, target, address, values, gap=0):
+        # A single value is written by Write Single Register (0x06), more by
+        # Write Multiple Registers (0x10)
+        unitId = target['unitId']
+        if len(values) == 1:
+            request = (lambda client: client.write_register(address=address, value=values[0], slave=unitId), 24)
+        else:
+            request = (lambda client: client.write_registers(address=address, values=values, slave=unitId), 25 + 2 * len(values))
+        (result,) = self.transact(target, [request], gap)
+        if result is None:
+            Domoticz.Debug("Unable to write registers 0x{:04x}+{} of {}.".format(address, len(values), target['name']))
+            return False
+        return True
+
         
+global _plugin
+_plugin = BasePlugin()
+
+def onStart():
+    global _plugin
+    _plugin.onStart()
+
+def onStop():
+    global _plugin
+    _plugin.onStop()
+
+def onHeartbeat():
+    global _plugin
+    _plugin.onHeartbeat()
+
+def onCommand(Unit, Command, Level, Color):
+    global _plugin
+    _plugin.onCommand(Unit, Command, Level)
+
+
+################################################################################
+# ModBus connection
+################################################################################
+
+class ModbusLink:
+    # One long-lived TCP client shared by all register reads and writes.
+    # Solax dongles are slow to accept new connections and often refuse them
+    # when polled frequently, so the socket is kept open between heartbeats.
+    # Every transaction runs under a short timeout and is retried with a
+    # growing delay; after BREAKER_THRESHOLD failed transactions in a row the
+    # circuit breaker opens, transactions fail at once and the host is probed
+    # again by a single transaction after a cooldown which grows on failure.
+    # Devices behind the inverter (EV Charger) need the link idle for a while
+    # before a request; the gap is measured from the end of the previous
+    # transaction, so time spent on other work counts towards it.
+
+    RETRY_DELAY = 0.5
+    BREAKER_THRESHOLD = 3
+    COOLDOWN_MIN = 10
+    COOLDOWN_MAX = 300
+
+    # Replaced by tools/replay.py to feed recorded traffic to the plugin
+    clientFactory = ModbusTcpClient
+
+    def __init__(self, address, port, timeout=3, retries=2, recorder=None):
+        self.address = address
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.recorder = recorder
+        self.client = None
+        self.failures = 0
+        self.cooldown = 0
+        self.openUntil = None
+        self.lastTransaction = float('-inf')
+        self.stopped = threading.Event()
+        self.counters = {
+            'connects': 0,
+            'reconnects': 0,
+            'failures': 0,
+            'drops': 0,
+            'retries': 0,
+            'errors': 0,
+            'rejected': 0,
+            'trips': 0,
+            'gaps': 0,
+            }
+
+    def isHealthy(self):
+        if self.client is None:
+            return False
         try:
-            client = ModbusTcpClient(host=self.__SETTINGS['address'], port=self.__SETTINGS['port'], timeout=30, retries=5)
-            client.connect()
+            return self.client.is_socket_open()
         except:
-            Domoticz.Debug("Connection timeout.")
-            client.close()
             return False
 
-        cycle = 0
-        step2 = step
-        registers = []
+    def isOpen(self):
+        # Circuit breaker is open - the host is considered down
+        return self.openUntil is not None
 
-        while cycle <= cycles:
-            if cycle == cycles:
-                if res > 0:
-                    step2 = res
-                else:
-                    break
-            try:
-                result = client.read_input_registers(address=(start + cycle * step), count=step2, slave=self.__SETTINGS['unitId'])
-                registers = registers + result.registers
-            except:
-                #Domoticz.Debug(result) 
-                Domoticz.Debug("Unable to read input registers.")
-                client.close()
-                return False
-            cycle = cycle + 1
+    def available(self):
+        # False while the breaker is open and the next probe is not due yet
+        return self.openUntil is None or time.monotonic() >= self.openUntil
 
-        client.close()
-        return(registers)
+    def getClient(self):
+        if self.isHealthy():
+            return self.client
 
-    def getHoldingRegisters(self, start=0, length=100, step=10):
-        Domoticz.Debug("Connecting to: {}:{}, unitID: {}".format(self.__SETTINGS['address'], self.__SETTINGS['port'], self.__SETTINGS['unitId']))
-        (cycles, res) = divmod(length, step)
-        
+        self.close()
         try:
-            client = ModbusTcpClient(host=self.__SETTINGS['address'], port=self.__SETTINGS['port'], timeout=30, retries=5)
-            client.connect()
+            client = self.clientFactory(host=self.address, port=self.port, timeout=self.timeout, retries=0)
+            if not client.connect():
+                raise ConnectionError
+            if self.recorder is not None:
+                client = RecordingClient(client, self.recorder)
         except:
-            Domoticz.Debug("Connection timeout.")
-            client.close()
-            return False
+            self.counters['failures'] += 1
+            Domoticz.Debug("Unable to connect to {}:{}.".format(self.address, self.port))
+            return None
+
+        if self.counters['connects'] > 0:
+            self.counters['reconnects'] += 1
+            Domoticz.Log("Reconnected to {}:{} ({} reconnect(s) so far).".format(self.address, self.port, self.counters['reconnects']))
+        self.counters['connects'] += 1
+        self.client = client
+        return self.client
+
+    def execute(self, request, gap=0):
+        # Runs request(client) and returns the response, or None when the
+        # transaction failed. An exception response means the inverter is
+        # reachable, so it is neither retried nor counted by the breaker.
+        if not self.available():
+            self.counters['rejected'] += 1
+            return None
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.counters['retries'] += 1
+                self.stopped.wait(self.RETRY_DELAY * 2 ** (attempt - 1))
+            if self.stopped.is_set():
+                return None
+            client = self.getClient()
+            if client is None:
+                continue
+            wait = self.lastTransaction + gap - time.monotonic()
+            if wait > 0:
+                self.counters['gaps'] += 1
+                self.stopped.wait(wait)
+            try:
+                response = request(client)
+            except Exception as err:
+                Domoticz.Debug("ModBus transaction with {}:{} failed: {}".format(self.address, self.port, err))
+                self.drop()
+                continue
+            finally:
+                self.lastTransaction = time.monotonic()
+            if isinstance(response, ExceptionResponse):
+                Domoticz.Debug("ModBus exception response from {}:{}: {}".format(self.address, self.port, response))
+                self.counters['errors'] += 1
+                self.recordSuccess()
+                return None
+            if response is None or response.isError():
+                Domoticz.Debug("ModBus transaction with {}:{} failed: {}".format(self.address, self.port, response))
+                self.drop()
+                continue
+            self.recordSuccess()
+            return response
+
+        self.recordFailure()
+        return None
+
+    def executeMany(self, requests, gap=0):
+        # Runs the requests one after another and returns (response, seconds)
+        # for each; after the first failure the rest is skipped (None, None)
+        results = []
+        for request in requests:
+            if results and results[-1][0] is None:
+                results.append((None, None))
+                continue
+            started = time.monotonic()
+            response = self.execute(request, gap)
+            results.append((response, time.monotonic() - started))
+        return results
+
+    def recordSuccess(self):
+        if self.openUntil is not None:
+            Domoticz.Log("ModBus link to {}:{} recovered.".format(self.address, self.port))
+        self.failures = 0
+        self.cooldown = 0
+        self.openUntil = None
+
+    def recordFailure(self):
+        self.failures += 1
+        if self.openUntil is not None or self.failures >= self.BREAKER_THRESHOLD:
+            self.cooldown = min(max(self.cooldown * 2, self.COOLDOWN_MIN), self.COOLDOWN_MAX)
+            self.openUntil = time.monotonic() + self.cooldown
+            self.counters['trips'] += 1
+            Domoticz.Log("ModBus link to {}:{} is down, next attempt in {}s.".format(self.address, self.port, self.cooldown))
+
+    def deadline(self, count, gap=0):
+        # Longest time (s) count transactions can take when every attempt
+        # times out on connect and on the request
+        attempts = self.retries + 1
+        return count * (attempts * (2 * self.timeout + gap) + self.RETRY_DELAY * (2 ** self.retries - 1))
+
+    def shutdown(self):
+        # Called from onStop; aborts a running transaction and stops retries
+        self.stopped.set()
+        self.close()
+
+    def drop(self):
+        # Called after a failed transaction; the socket state is unknown so
+        # it is closed and the next request reconnects.
+        self.counters['drops'] += 1
+        self.close()
+
+    def close(self):
+        if self.client is not None:
+            try:
+                self.client.close()
+            except:
+                pass
+            self.client = None
 
-        cycle = 0
-        step2 = step
-        registers = []
+    def stats(self):
+        return dict(self.counters, connected=self.isHealthy(), breaker='open' if self.isOpen() else 'closed')
 
-        while cycle <= cycles:
-            if cycle == cycles:
-                if res > 0:
-                    step2 = res
-                else:
-                    break
+
+class EventLoop:
+    # asyncio event loop running in its own thread, shared by all
+    # AsyncModbusLinks. Worker threads hand coroutines over and wait.
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="SolaxModbusLoop", daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine, timeout=None):
+        # Raises TimeoutError (the coroutine is cancelled) after timeout
+        # seconds, so a worker never waits on a stopped loop for ever
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(10)
+        if not self.thread.is_alive():
+            self.loop.close()
+
+
+class AsyncModbusLink(ModbusLink):
+    # ModbusLink on pymodbus' asyncio client. The async client waits for the
+    # response before it sends the next request, so requests of one
+    # executeMany are spread over a pool of up to inFlight connections and
+    # run concurrently. Retries, the circuit breaker and the gap work as on
+    # ModbusLink; requests with a gap run one at a time.
+
+    clientFactory = AsyncModbusTcpClient
+
+    def __init__(self, eventLoop, address, port, timeout=3, retries=2, recorder=None, inFlight=2):
+        super().__init__(address, port, timeout, retries, recorder)
+        self.eventLoop = eventLoop
+        self.inFlight = inFlight
+        self.idle = []
+        self.clients = set()
+        self.slots = None
+
+    def isHealthy(self):
+        return any(client.connected for client in self.idle)
+
+    def execute(self, request, gap=0):
+        return self.executeMany([request], gap)[0][0]
+
+    def executeMany(self, requests, gap=0):
+        try:
+            return self.eventLoop.run(self.executeAll(requests, gap), self.deadline(len(requests), gap) + 1)
+        except concurrent.futures.TimeoutError:
+            Domoticz.Error("ModBus transactions with {}:{} did not finish in time.".format(self.address, self.port))
+            return [(None, None)] * len(requests)
+
+    async def executeAll(self, requests, gap):
+        # Created here, as it belongs to the loop on older Pythons
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.inFlight)
+        serial = asyncio.Semaphore(1) if gap else None
+        return await asyncio.gather(*[self.executeTimed(request, gap, serial) for request in requests])
+
+    async def executeTimed(self, request, gap, serial):
+        async with self.slots:
+            if serial is None:
+                started = time.monotonic()
+                return (await self.executeOne(request, gap), time.monotonic() - started)
+            async with serial:
+                started = time.monotonic()
+                return (await self.executeOne(request, gap), time.monotonic() - started)
+
+    async def executeOne(self, request, gap):
+        if not self.available():
+            self.counters['rejected'] += 1
+            return None
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                self.counters['retries'] += 1
+                await asyncio.sleep(self.RETRY_DELAY * 2 ** (attempt - 1))
+            if self.stopped.is_set():
+                return None
+            client = await self.acquire()
+            if client is None:
+                continue
+            wait = self.lastTransaction + gap - time.monotonic()
+            if wait > 0:
+                self.counters['gaps'] += 1
+                await asyncio.sleep(wait)
             try:
-                result = client.read_holding_registers(address=(start + cycle * step), count=step2, slave=self.__SETTINGS['unitId'])
-                registers = registers + result.registers
-            except:
-                #Domoticz.Debug(result) 
-                Domoticz.Debug("Unable to read holding registers.")
+                response = await request(client)
+            except Exception as err:
+                Domoticz.Debug("ModBus transaction with {}:{} failed: {}".format(self.address, self.port, err))
+                self.counters['drops'] += 1
+                self.clients.discard(client)
                 client.close()
-                return False
-            cycle = cycle + 1
+                continue
+            finally:
+                self.lastTransaction = time.monotonic()
+            if isinstance(response, ExceptionResponse):
+                Domoticz.Debug("ModBus exception response from {}:{}: {}".format(self.address, self.port, response))
+                self.counters['errors'] += 1
+                self.recordSuccess()
+                self.idle.append(client)
+                return None
+            if response is None or response.isError():
+                Domoticz.Debug("ModBus transaction with {}:{} failed: {}".format(self.address, self.port, response))
+                self.counters['drops'] += 1
+                self.clients.discard(client)
+                client.close()
+                continue
+            self.recordSuccess()
+            self.idle.append(client)
+            return response
+
+        self.recordFailure()
+        return None
+
+    async def acquire(self):
+        # An idle pooled connection or a new one; a slot is already held, so
+        # there are never more than inFlight connections
+        while self.idle:
+            client = self.idle.pop()
+            if client.connected:
+                return client
+            self.clients.discard(client)
+            client.close()
 
-        client.close()
-        return(registers)
-    
-    def setRegister(self, start, payload):
-        Domoticz.Debug("Connecting to: {}:{}, unitID: {}".format(self.__SETTINGS['address'], self.__SETTINGS['port'], self.__SETTINGS['unitId']))
-        
         try:
-            client = ModbusTcpClient(host=self.__SETTINGS['address'], port=self.__SETTINGS['port'], timeout=30, retries=5)
-            client.connect()
+            client = self.clientFactory(host=self.address, port=self.port, timeout=self.timeout, retries=0, reconnect_delay=0)
+            if not await client.connect():
+                raise ConnectionError
+            if self.recorder is not None:
+                client = RecordingClient(client, self.recorder)
         except:
-            Domoticz.Debug("Connection timeout.")
-            client.close()
-            return False
-        
+            self.counters['failures'] += 1
+            Domoticz.Debug("Unable to connect to {}:{}.".format(self.address, self.port))
+            return None
+
+        # Connections beyond the pool size replace lost ones
+        if self.counters['connects'] >= self.inFlight:
+            self.counters['reconnects'] += 1
+            Domoticz.Log("Reconnected to {}:{} ({} reconnect(s) so far).".format(self.address, self.port, self.counters['reconnects']))
+        self.counters['connects'] += 1
+        self.clients.add(client)
+        return client
+
+    def close(self):
+        # Connections in use are closed too, which aborts their requests
+        (clients, self.clients, self.idle) = (self.clients, set(), [])
+        for client in clients:
+            self.eventLoop.loop.call_soon_threadsafe(client.close)
+
+
+################################################################################
+# ModBus traffic recording
+################################################################################
+
+class TrafficRecorder:
+    # Appends ModBus transactions to a compact binary log, rotated to
+    # path.1 .. path.BACKUPS when it grows over maxBytes. The log starts with
+    # MAGIC and VERSION; every record is a RECORD header followed by its
+    # 16-bit words - registers read, values written or the exception code.
+    # Used from the link's worker thread only.
+
+    MAGIC = b'SLXR'
+    VERSION = 1
+    FILE_HEADER = struct.Struct('<4sH')
+    RECORD = struct.Struct('<dfBBBHHH')             # time, duration, function, unit, status, address, count, words
+    BACKUPS = 3
+
+    STATUS_OK = 0
+    STATUS_EXCEPTION = 1
+    STATUS_FAILED = 2
+
+    def __init__(self, path, maxBytes):
+        self.path = path
+        self.maxBytes = maxBytes
+        self.file = None
+        self.size = 0
+
+    def open(self):
         try:
-            result = client.write_register(address=start, value=payload, slave=self.__SETTINGS['unitId'])
-        except:
-            #Domoticz.Debug(result) 
-            Domoticz.Debug("Unable to write holding register.")
-            client.close()
-            return False
+            self.file = open(self.path, 'ab')
+            self.size = self.file.tell()
+            if self.size == 0:
+                self.file.write(self.FILE_HEADER.pack(self.MAGIC, self.VERSION))
+                self.size = self.FILE_HEADER.size
+        except OSError as err:
+            Domoticz.Error("Unable to open ModBus traffic log {}: {}".format(self.path, err))
+            self.file = None
+
+    def rotate(self):
+        self.close()
+        try:
+            for index in range(self.BACKUPS - 1, 0, -1):
+                if os.path.exists("{}.{}".format(self.path, index)):
+                    os.replace("{}.{}".format(self.path, index), "{}.{}".format(self.path, index + 1))
+            os.replace(self.path, self.path + '.1')
+        except OSError as err:
+            Domoticz.Error("Unable to rotate ModBus traffic log {}: {}".format(self.path, err))
+
+    def record(self, started, duration, function, unitId, status, address, count, words):
+        words = [int(word) & 0xffff for word in words]
+        data = self.RECORD.pack(started, duration, function, unitId, status, address, count, len(words)) + struct.pack('<{}H'.format(len(words)), *words)
+        if self.file is not None and self.size + len(data) > self.maxBytes:
+            self.rotate()
+        if self.file is None:
+            self.open()
+            if self.file is None:
+                return
+        try:
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+        except OSError as err:
+            Domoticz.Error("Unable to write ModBus traffic log {}: {}".format(self.path, err))
+            self.close()
+
+    def close(self):
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+
+    @classmethod
+    def read(cls, path):
+        # Yields (time, duration, function, unit, status, address, count, words)
+        with open(path, 'rb') as logFile:
+            data = logFile.read()
+        if len(data) < cls.FILE_HEADER.size or cls.FILE_HEADER.unpack_from(data) != (cls.MAGIC, cls.VERSION):
+            raise ValueError("{} is not a ModBus traffic log.".format(path))
+        position = cls.FILE_HEADER.size
+        while position + cls.RECORD.size <= len(data):
+            record = cls.RECORD.unpack_from(data, position)
+            position += cls.RECORD.size
+            count = record[-1]
+            if position + count * 2 > len(data):
+                break
+            words = struct.unpack_from('<{}H'.format(count), data, position)
+            position += count * 2
+            yield record[:-1] + (words,)
 
-        client.close()
-        return(True)
-    
-    def setMultipleRegisters(self, start, payload):
-        Domoticz.Debug("Connecting to: {}:{}, unitID: {}".format(self.__SETTINGS['address'], self.__SETTINGS['port'], self.__SETTINGS['unitId']))
-        
+
+class RecordingClient:
+    # ModbusTcpClient proxy logging every transaction to a TrafficRecorder
+
+    def __init__(self, client, recorder):
+        self.client = client
+        self.recorder = recorder
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def transact(self, function, unitId, address, count, words, request):
+        started = time.time()
+        timer = time.monotonic()
         try:
-            client = ModbusTcpClient(host=self.__SETTINGS['address'], port=self.__SETTINGS['port'], timeout=30, retries=5)
-            client.connect()
-        except:
-            Domoticz.Debug("Connection timeout.")
-            client.close()
+            response = request()
+        except Exception:
+            self.recorder.record(started, time.monotonic() - timer, function, unitId, TrafficRecorder.STATUS_FAILED, address, count, words)
+            raise
+        if asyncio.iscoroutine(response):
+            return self.transactAsync(function, unitId, address, count, words, response, started, timer)
+        return self.recordResponse(function, unitId, address, count, words, response, started, timer)
+
+    async def transactAsync(self, function, unitId, address, count, words, coroutine, started, timer):
+        # Same as transact for an async client, recorded once awaited
+        try:
+            response = await coroutine
+        except Exception:
+            self.recorder.record(started, time.monotonic() - timer, function, unitId, TrafficRecorder.STATUS_FAILED, address, count, words)
+            raise
+        return self.recordResponse(function, unitId, address, count, words, response, started, timer)
+
+    def recordResponse(self, function, unitId, address, count, words, response, started, timer):
+        duration = time.monotonic() - timer
+        if isinstance(response, ExceptionResponse):
+            self.recorder.record(started, duration, function, unitId, TrafficRecorder.STATUS_EXCEPTION, address, count, (response.exception_code,))
+        elif response is None or response.isError():
+            self.recorder.record(started, duration, function, unitId, TrafficRecorder.STATUS_FAILED, address, count, words)
+        else:
+            self.recorder.record(started, duration, function, unitId, TrafficRecorder.STATUS_OK, address, count,
+                response.registers if function in (0x03, 0x04) else words)
+        return response
+
+    def read_holding_registers(self, address, count=1, slave=0):
+        return self.transact(0x03, slave, address, count, (),
+            lambda: self.client.read_holding_registers(address=address, count=count, slave=slave))
+
+    def read_input_registers(self, address, count=1, slave=0):
+        return self.transact(0x04, slave, address, count, (),
+            lambda: self.client.read_input_registers(address=address, count=count, slave=slave))
+
+    def write_register(self, address, value, slave=0):
+        return self.transact(0x06, slave, address, 1, (value,),
+            lambda: self.client.write_register(address=address, value=value, slave=slave))
+
+    def write_registers(self, address, values, slave=0):
+        return self.transact(0x10, slave, address, len(values), values,
+            lambda: self.client.write_registers(address=address, values=values, slave=slave))
+
+
+################################################################################
+# ModBus worker
+################################################################################
+
+class ModbusWorker(threading.Thread):
+    # Owns all ModBus I/O so that Domoticz callbacks never wait for the
+    # inverter. Transactions are serialized on the link; the next job is the
+    # ready one with the best priority, so writes overtake queued periodic
+    # reads. Submitting a job with the key of one still queued replaces it.
+    # Results are handed back to the plugin thread, which alone touches Devices.
+
+    PRIORITY_WRITE = 0
+    PRIORITY_READ = 1
+
+    STOP_TIMEOUT = 10
+
+    def __init__(self):
+        super().__init__(name="SolaxModBus", daemon=True)
+        self.condition = threading.Condition()
+        self.jobs = []
+        self.sequence = 0
+        self.stopping = False
+        self.results = queue.Queue()
+        self.counters = {
+            'superseded': 0,
+            'failed': 0,
+            }
+        self.waits = {
+            # priority: [jobs, total wait, max wait]
+            self.PRIORITY_WRITE: [0, 0.0, 0.0],
+            self.PRIORITY_READ: [0, 0.0, 0.0],
+            }
+
+    def submit(self, function, args=(), callback=None, priority=PRIORITY_READ, key=None, delay=0):
+        now = time.monotonic()
+        with self.condition:
+            if key is not None:
+                self.counters['superseded'] += self.cancel(key)
+            self.sequence += 1
+            self.jobs.append({
+                'function': function,
+                'args': args,
+                'callback': callback,
+                'priority': priority,
+                'key': key,
+                'sequence': self.sequence,
+                'ready': now + delay,
+                })
+            self.condition.notify()
+
+    def cancel(self, key):
+        # Drops the queued job with the key; returns the number dropped
+        with self.condition:
+            queued = len(self.jobs)
+            self.jobs = [job for job in self.jobs if job['key'] != key]
+            return queued - len(self.jobs)
+
+    def isQueued(self, key):
+        with self.condition:
+            return any(job['key'] == key for job in self.jobs)
+
+    def nextJob(self):
+        # Returns (job, None) or (None, seconds until the next job is ready)
+        now = time.monotonic()
+        ready = [job for job in self.jobs if job['ready'] <= now]
+        if ready:
+            job = min(ready, key=lambda job: (job['priority'], job['sequence']))
+            self.jobs.remove(job)
+            return (job, None)
+        if self.jobs:
+            return (None, min(job['ready'] for job in self.jobs) - now)
+        return (None, None)
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    if self.stopping:
+                        return
+                    (job, timeout) = self.nextJob()
+                    if job is not None:
+                        break
+                    self.condition.wait(timeout)
+
+            wait = time.monotonic() - job['ready']
+            stats = self.waits[job['priority']]
+            stats[0] += 1
+            stats[1] += wait
+            stats[2] = max(stats[2], wait)
+
+            try:
+                result = job['function'](*job['args'])
+            except Exception as err:
+                Domoticz.Error("ModBus job {} failed: {}".format(job['function'].__name__, err))
+                self.counters['failed'] += 1
+                result = None
+            self.results.put((job['callback'], result))
+
+    def processResults(self):
+        # Called from the plugin thread
+        while True:
+            try:
+                (callback, result) = self.results.get_nowait()
+            except queue.Empty:
+                break
+            if callback is not None:
+                callback(result)
+
+    def stats(self):
+        with self.condition:
+            depth = len(self.jobs)
+        stats = dict(self.counters, depth=depth)
+        for (priority, name) in ((self.PRIORITY_WRITE, 'write'), (self.PRIORITY_READ, 'read')):
+            (count, total, maximum) = self.waits[priority]
+            stats[name + 's'] = count
+            stats[name + 'WaitAvg'] = round(total / count, 3) if count else 0
+            stats[name + 'WaitMax'] = round(maximum, 3)
+        return stats
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.jobs = []
+            self.condition.notify()
+        self.join(self.STOP_TIMEOUT)
+        if self.is_alive():
+            Domoticz.Error("ModBus worker did not stop within {}s.".format(self.STOP_TIMEOUT))
+
+
+################################################################################
+# Remote control
+################################################################################
+
+class RemoteControl:
+    # Remote control session of one inverter. The settings are turned into
+    # the 13 register block written at 0x007c (32-bit values low word first);
+    # a block equal to the last confirmed one is not written again while the
+    # inverter still reports its mode. A write is confirmed when the read
+    # back registers 0x0100 - 0x011e show the written mode and targets.
+
+    MODES = (0, 1, 2, 3, 7)
+
+    def __init__(self):
+        self.acknowledged = None
+        self.mode = None
+        self.lastWrite = float('-inf')
+        # Writes handed to the worker: {'payload', 'at' (dispatch time)}
+        self.queued = None
+        self.running = None
+        self.counters = {
+            'triggers': 0,
+            'skipped': 0,
+            'coalesced': 0,
+            'confirmed': 0,
+            'unconfirmed': 0,
+            }
+
+    def payload(self, rc):
+        def words(value):
+            return [value & 0xffff, (value >> 16) & 0xffff]
+
+        return ([self.MODES[int(int(rc['Mode']) / 10)],                    # Remote Control Mode
+                1]                                                          # TargetSet type = SET
+            + words(int(rc['PowerTarget']))                                 # Target Active Power
+            + words(0)                                                      # Target Reactive Power
+            + [int(rc['DurationTime']),                                     # Time of Duration
+                int(rc['SOCTarget'])]                                       # Target SOC
+            + words(int(rc['EnergyTarget']))                                # Target Energy
+            + words(int(rc['ChargerPower']))                                # Charge / Discharge Power
+            + [int(rc['TimeOut'])])                                         # Remote Control Timeout
+
+    def isRunning(self, payload):
+        return payload == self.acknowledged and self.mode == payload[0]
+
+    def confirm(self, payload, values):
+        def value(low, high):
+            return struct.unpack('<i', struct.pack('<HH', low, high))[0]
+
+        confirmed = (
+            values['rcMode'] == payload[0]
+            and values['rcPowerTarget'] == value(payload[2], payload[3])
+            and values['rcSOCTarget'] == payload[7]
+            and values['rcEnergyTarget'] == value(payload[8], payload[9])
+            and values['rcChargerPower'] == value(payload[10], payload[11])
+            )
+        self.acknowledged = payload if confirmed else None
+        self.counters['confirmed' if confirmed else 'unconfirmed'] += 1
+        return confirmed
+
+
+################################################################################
+# Register decoding
+################################################################################
+
+class RegisterMap:
+    # Declarative register table compiled into one struct unpack plan.
+    # Registers are kept as native 16-bit words (array 'H'), so the whole
+    # table is decoded by a single unpack_from call; 32-bit values use the
+    # Solax word order (low word first), which is the native layout on
+    # little-endian hosts, elsewhere the words are joined afterwards.
+
+    TYPES = {
+        # type: (struct codes, width in registers, native 32-bit code)
+        'uint16': ('H', 1, None),
+        'int16': ('h', 1, None),
+        'uint32': ('HH', 2, 'I'),
+        'int32': ('Hh', 2, 'i'),
+        'string14': ('7H', 7, None),
+        }
+
+    NATIVE_WORD_ORDER = sys.byteorder == 'little'
+
+    def __init__(self, fields):
+        self.fields = sorted(fields, key=lambda field: field[1])
+        self.plan = []
+        self.units = []
+
+        fmt = '='
+        position = 0
+        for (name, offset, type, scale, unit, fmtValue) in self.fields:
+            if offset < position:
+                raise ValueError("Register field '{}' at 0x{:04x} overlaps previous field.".format(name, offset))
+            (codes, width, native) = self.TYPES[type]
+            if offset > position:
+                fmt += "{}x".format((offset - position) * 2)
+            # slots - number of unpacked items holding the value
+            slots = width
+            if native and self.NATIVE_WORD_ORDER:
+                codes = native
+                slots = 1
+            fmt += codes
+            position = offset + width
+            self.plan.append((name, slots, scale, type.startswith('string')))
+            if unit:
+                self.units.append((unit, name, fmtValue))
+
+        self.struct = struct.Struct(fmt)
+        self.length = position
+
+    def subset(self, names):
+        return RegisterMap([field for field in self.fields if field[0] in names])
+
+    def planBlocks(self, maxGap, maxBlock):
+        # Merge the registers of all fields into the fewest (start, count)
+        # requests, bridging holes of up to maxGap unused registers.
+        blocks = []
+        for (name, offset, type, scale, unit, fmtValue) in self.fields:
+            (codes, width, native) = self.TYPES[type]
+            for address in range(offset, offset + width):
+                if blocks:
+                    (start, count) = blocks[-1]
+                    if address - (start + count) <= maxGap and address - start < maxBlock:
+                        blocks[-1] = (start, address - start + 1)
+                        continue
+                blocks.append((address, 1))
+        return blocks
+
+    def decode(self, registers):
+        if len(registers) < self.length:
+            return None
+        if not isinstance(registers, array):
+            registers = array('H', registers)
+
+        raw = self.struct.unpack_from(registers)
+        values = {}
+        index = 0
+        for (name, slots, scale, text) in self.plan:
+            if text:
+                # Two ASCII characters per register, high byte first
+                val = struct.pack('>{}H'.format(slots), *raw[index:index + slots]).decode('ascii', 'replace').strip('\x00 ')
+            elif slots == 1:
+                val = raw[index]
+            else:
+                val = (raw[index + 1] << 16) | raw[index]
+            index += slots
+            if scale != 1:
+                val *= scale
+            values[name] = val
+        return values
+
+    def decodeBatch(self, registers, width=None):
+        # Decode N register images of width registers each, stored row after
+        # row in one flat buffer, into a column per field. One iter_unpack
+        # pass with the same signedness, word order and scaling as decode();
+        # numeric columns are array('q'), string columns lists.
+        width = width or self.length
+        if width < self.length:
+            raise ValueError("Register images of {} registers are shorter than the map ({}).".format(width, self.length))
+        if not isinstance(registers, array):
+            registers = array('H', registers)
+        if len(registers) % width:
+            raise ValueError("Buffer of {} registers is not a multiple of {}.".format(len(registers), width))
+
+        rows = self.struct
+        if width > self.length:
+            rows = struct.Struct(self.struct.format + "{}x".format((width - self.length) * 2))
+        raw = list(zip(*rows.iter_unpack(registers)))
+        if not raw:
+            return {name: [] if text else array('q') for (name, slots, scale, text) in self.plan}
+
+        columns = {}
+        index = 0
+        for (name, slots, scale, text) in self.plan:
+            if text:
+                fmt = '>{}H'.format(slots)
+                columns[name] = [struct.pack(fmt, *row).decode('ascii', 'replace').strip('\x00 ') for row in zip(*raw[index:index + slots])]
+            else:
+                if slots == 1:
+                    column = raw[index]
+                else:
+                    column = [(hi << 16) | lo for (lo, hi) in zip(raw[index], raw[index + 1])]
+                if scale != 1:
+                    column = [val * scale for val in column]
+                columns[name] = array('q', column)
+            index += slots
+        return columns
+
+
+################################################################################
+# Register history
+################################################################################
+
+class RegisterHistory:
+    # Fixed-size ring buffer of decoded register snapshots. A record is the
+    # wall clock timestamp followed by one double per field (NaN when the
+    # field was not read), so power changes are taken from raw values
+    # instead of device strings. With a path the buffer is a memory
+    # mapped file which survives restarts; a file of a different layout or
+    # size is started afresh.
+
+    MAGIC = b'SLXH'
+    VERSION = 1
+    HEADER = struct.Struct('<4sHHIIII')         # magic, version, fields, capacity, head, count, layout
+
+    def __init__(self, fields, capacity, path=None):
+        self.fields = list(fields)
+        self.positions = {name: index + 1 for (index, name) in enumerate(self.fields)}
+        self.capacity = capacity
+        self.path = path
+        self.record = struct.Struct('<{}d'.format(len(self.fields) + 1))
+        self.layout = zlib.crc32(','.join(self.fields).encode())
+        self.size = self.HEADER.size + capacity * self.record.size
+        self.file = None
+        self.buffer = None
+        self.head = 0
+        self.count = 0
+
+        if path:
+            self.open(path)
+        if self.buffer is None:
+            self.buffer = bytearray(self.size)
+            self.writeHeader()
+
+    def open(self, path):
+        try:
+            self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+            if os.fstat(self.file.fileno()).st_size != self.size:
+                self.file.truncate(self.size)
+            self.buffer = mmap.mmap(self.file.fileno(), self.size)
+        except (OSError, ValueError) as err:
+            Domoticz.Error("Unable to open register history {}: {}".format(path, err))
+            self.close()
+            return
+
+        (magic, version, fields, capacity, head, count, layout) = self.HEADER.unpack_from(self.buffer)
+        if ((magic, version, fields, capacity, layout) == (self.MAGIC, self.VERSION, len(self.fields), self.capacity, self.layout)
+                and head < capacity and count <= capacity):
+            self.head = head
+            self.count = count
+            Domoticz.Debug("Register history {} loaded with {} record(s).".format(path, count))
+        else:
+            Domoticz.Debug("Register history {} started afresh.".format(path))
+            self.writeHeader()
+
+    def writeHeader(self):
+        self.HEADER.pack_into(self.buffer, 0, self.MAGIC, self.VERSION, len(self.fields), self.capacity, self.head, self.count, self.layout)
+
+    def append(self, timestamp, values):
+        nan = float('nan')
+        self.record.pack_into(self.buffer, self.HEADER.size + self.head * self.record.size,
+            timestamp, *[values.get(name, nan) for name in self.fields])
+        self.head = (self.head + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self.writeHeader()
+
+    def last(self, name):
+        # Latest recorded value of the field, or None; NaN is skipped
+        position = self.positions[name]
+        for index in range(1, self.count + 1):
+            record = self.record.unpack_from(self.buffer, self.HEADER.size + ((self.head - index) % self.capacity) * self.record.size)
+            if record[position] == record[position]:
+                return record[position]
+        return None
+
+    def close(self):
+        if isinstance(self.buffer, mmap.mmap):
+            try:
+                self.buffer.flush()
+                self.buffer.close()
+            except (OSError, ValueError):
+                pass
+            self.buffer = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+################################################################################
+# Power sampling
+################################################################################
+
+class PowerSampler:
+    # Fast power samples of one inverter between two polls, in a ring buffer
+    # of fixed size (the oldest samples are overwritten when polls stall).
+    # add() runs in the worker thread, take() in the main thread.
+
+    def __init__(self, fields, capacity):
+        self.fields = fields
+        self.capacity = capacity
+        self.columns = {name: array('d', bytes(8 * capacity)) for name in fields}
+        self.position = 0
+        self.count = 0
+        self.lock = threading.Lock()
+        self.counters = {
+            'samples': 0,
+            'overwritten': 0,
+            }
+
+    def add(self, values):
+        with self.lock:
+            for name in self.fields:
+                self.columns[name][self.position] = values[name]
+            self.position = (self.position + 1) % self.capacity
+            if self.count < self.capacity:
+                self.count += 1
+            else:
+                self.counters['overwritten'] += 1
+            self.counters['samples'] += 1
+
+    def take(self):
+        # Returns (samples, {field: (min, max, mean, last)}) of the samples
+        # since the previous call and empties the buffer
+        with self.lock:
+            count = self.count
+            if not count:
+                return (0, {})
+            start = (self.position - count) % self.capacity
+            aggregates = {}
+            for (name, column) in self.columns.items():
+                if start + count <= self.capacity:
+                    window = column[start:start + count]
+                else:
+                    window = column[start:] + column[:self.position]
+                aggregates[name] = (min(window), max(window), sum(window) / count, column[(self.position - 1) % self.capacity])
+            self.count = 0
+        return (count, aggregates)
+
+
+################################################################################
+# Energy integration
+################################################################################
+
+class EnergyIntegrator:
+    # Integrates power samples (W) taken at irregular intervals into energy
+    # (Wh) with the trapezoidal rule. Intervals longer than maxGap are not
+    # interpolated; their energy is taken from a cumulative counter sampled
+    # along with the power, unless the counter went backwards (reset).
+
+    def __init__(self, maxGap, state=None):
+        self.maxGap = maxGap
+        self.energy = 0.0
+        self.time = None
+        self.power = None
+        self.counter = None
+        self.gaps = 0
+        if state:
+            try:
+                self.energy = float(state['energy'])
+                self.time = state['time']
+                self.power = state['power']
+                self.counter = state['counter']
+            except (KeyError, TypeError, ValueError):
+                Domoticz.Error("Ignoring invalid energy integrator state: {}".format(state))
+
+    def add(self, timestamp, power, counter=None):
+        if self.time is not None:
+            elapsed = timestamp - self.time
+            if elapsed <= 0:
+                # Clock stepped back; the sample only restarts integration
+                pass
+            elif elapsed <= self.maxGap:
+                self.energy += (self.power + power) / 2 * elapsed / 3600
+            else:
+                self.gaps += 1
+                if counter is not None and self.counter is not None and counter >= self.counter:
+                    self.energy += counter - self.counter
+                    Domoticz.Debug("Energy gap of {:.0f}s bridged by counters ({} Wh).".format(elapsed, counter - self.counter))
+                else:
+                    Domoticz.Debug("Energy gap of {:.0f}s skipped.".format(elapsed))
+        self.time = timestamp
+        self.power = power
+        self.counter = counter
+
+    def state(self):
+        return {
+            'energy': round(self.energy, 3),
+            'time': self.time,
+            'power': self.power,
+            'counter': self.counter,
+            }
+
+
+################################################################################
+# Counter validation
+################################################################################
+
+class CounterFilter:
+    # Validates the monotonic energy counters (Wh) of one target before any
+    # device sees them. Each counter is reported as raw value + offset, so it
+    # continues across a wraparound of the register. A value below the last
+    # good one, or above what maxPower (W) could add since then, is rejected
+    # and the last good value is reported instead. A rejected value which
+    # stays consistent for CONFIRM reads (a counter really reset or replaced)
+    # becomes the new baseline, continuing from the last good value without
+    # the jump: the energy counted since the first rejected value, or since 0
+    # when the counter plausibly restarted from 0, is kept. Raw value, offset
+    # and time of the last good value persist.
+
+    CONFIRM = 3
+    SLACK = 1.5
+
+    def __init__(self, maxPower, state=None):
+        self.maxPower = maxPower
+        self.counters = {}
+        self.pending = {}
+        self.counts = {
+            'accepted': 0,
+            'rejected': 0,
+            'wrapped': 0,
+            'rebased': 0,
+            }
+        for (name, counter) in (state or {}).items():
+            try:
+                self.counters[name] = {'raw': counter['raw'], 'offset': counter['offset'], 'time': float(counter['time'])}
+            except (KeyError, TypeError, ValueError):
+                pass
+
+    def bound(self, elapsed, resolution):
+        # Largest plausible increase (Wh) over elapsed seconds
+        return self.maxPower * max(0, elapsed) / 3600 * self.SLACK + resolution
+
+    def filter(self, name, raw, timestamp, span, resolution):
+        counter = self.counters.get(name)
+        if counter is None:
+            self.counters[name] = {'raw': raw, 'offset': 0, 'time': timestamp}
+            self.counts['accepted'] += 1
+            return raw
+
+        delta = raw - counter['raw']
+        wrapped = delta < 0 and counter['raw'] > span * 0.9 and raw < span * 0.1
+        if wrapped:
+            delta += span
+        if 0 <= delta <= self.bound(timestamp - counter['time'], resolution):
+            if wrapped:
+                counter['offset'] += span
+                self.counts['wrapped'] += 1
+            counter['raw'] = raw
+            counter['time'] = timestamp
+            self.pending.pop(name, None)
+            self.counts['accepted'] += 1
+            return raw + counter['offset']
+
+        self.counts['rejected'] += 1
+        Domoticz.Debug("Counter {} rejected: {} after {} (delta {}).".format(name, raw, counter['raw'], delta))
+        pending = self.pending.get(name)
+        if pending is not None and 0 <= raw - pending['raw'] <= self.bound(timestamp - pending['time'], resolution):
+            pending['count'] += 1
+            pending['raw'] = raw
+            pending['time'] = timestamp
+        else:
+            # A reset counter counts from 0, a replaced one from its first value
+            start = 0 if raw <= self.bound(timestamp - counter['time'], resolution) else raw
+            pending = self.pending[name] = {'raw': raw, 'time': timestamp, 'count': 1, 'start': start}
+        if pending['count'] >= self.CONFIRM:
+            Domoticz.Log("Counter {} continues from a new baseline: {} after {}.".format(name, raw, counter['raw']))
+            counter['offset'] += counter['raw'] - pending['start']
+            counter['raw'] = raw
+            counter['time'] = timestamp
+            del self.pending[name]
+            self.counts['rebased'] += 1
+        return counter['raw'] + counter['offset']
+
+    def state(self):
+        return {name: dict(counter) for (name, counter) in self.counters.items()}
+
+
+################################################################################
+# Tariff accounting
+################################################################################
+
+class TariffMeter:
+    # Grid import and export energy (Wh) split into tariffs T1 (index 0) and
+    # T2 (index 1). Readings of the inverter's grid counters are turned into
+    # deltas added to the active tariff; a counter going backwards (reset)
+    # only moves the baseline.
+
+    def __init__(self, state=None):
+        self.imported = [0, 0]
+        self.exported = [0, 0]
+        self.importCounter = None
+        self.exportCounter = None
+        self.tariff = 0
+        if state:
+            try:
+                imported = [int(value) for value in state['imported']]
+                exported = [int(value) for value in state['exported']]
+                if len(imported) != 2 or len(exported) != 2:
+                    raise ValueError
+                self.imported = imported
+                self.exported = exported
+                self.importCounter = state.get('importCounter')
+                self.exportCounter = state.get('exportCounter')
+            except (KeyError, TypeError, ValueError):
+                Domoticz.Error("Ignoring invalid tariff meter state: {}".format(state))
+
+    def add(self, importCounter, exportCounter):
+        if self.importCounter is not None and importCounter >= self.importCounter:
+            self.imported[self.tariff] += importCounter - self.importCounter
+        if self.exportCounter is not None and exportCounter >= self.exportCounter:
+            self.exported[self.tariff] += exportCounter - self.exportCounter
+        self.importCounter = importCounter
+        self.exportCounter = exportCounter
+
+    def state(self):
+        return {
+            'imported': list(self.imported),
+            'exported': list(self.exported),
+            'importCounter': self.importCounter,
+            'exportCounter': self.exportCounter,
+            }
+
+
+class EnergyTotal:
+    # Energy total (Wh) of a device fed by readings of a cumulative counter.
+    # Each reading adds its change since the previous one; a counter going
+    # backwards (reset) only moves the baseline.
+
+    def __init__(self, state=None):
+        self.energy = 0.0
+        self.counter = None
+        if state:
+            try:
+                self.energy = float(state['energy'])
+                self.counter = state.get('counter')
+            except (KeyError, TypeError, ValueError):
+                Domoticz.Error("Ignoring invalid energy total state: {}".format(state))
+
+    def add(self, counter):
+        if self.counter is not None and counter >= self.counter:
+            self.energy += counter - self.counter
+        self.counter = counter
+
+    def state(self):
+        return {
+            'energy': round(self.energy, 3),
+            'counter': self.counter,
+            }
+
+
+################################################################################
+# Device update pipeline
+################################################################################
+
+class DeviceUpdates:
+    # Shadow of the last values published to each Domoticz device. Updates
+    # equal to the shadow (or within the unit's deadband) are dropped without
+    # touching Devices; the rest is queued and written in one batch by flush().
+    # Units marked as timed out keep the flag on every update until cleared.
+
+    MAX_UPDATE_INTERVAL = 600
+
+    def __init__(self):
+        self.shadow = {}
+        self.pending = {}
+        self.deadbands = {}
+        self.timedOut = set()
+        self.counters = {
+            'issued': 0,
+            'skipped': 0,
+            }
+        # unit: [updates queued, updates skipped], counted when update() is
+        # called, so per cycle figures do not wait for the flush
+        self.unitCounts = {}
+
+    def update(self, unit, nValue, sValue, TimedOut=None, AlwaysUpdate=False):
+        sValue = str(sValue)
+        if TimedOut is None:
+            TimedOut = 1 if unit in self.timedOut else 0
+        if not AlwaysUpdate and unit in self.shadow:
+            (lastN, lastS, lastTimedOut, lastTime) = self.shadow[unit]
+            if (
+                lastN == nValue
+                and lastTimedOut == TimedOut
+                and time.monotonic() - lastTime < self.MAX_UPDATE_INTERVAL
+                and (lastS == sValue or self.withinDeadband(unit, lastS, sValue))
+            ):
+                self.pending.pop(unit, None)
+                self.counters['skipped'] += 1
+                self.unitCounts.setdefault(unit, [0, 0])[1] += 1
+                return
+        self.pending[unit] = (nValue, sValue, TimedOut)
+        self.unitCounts.setdefault(unit, [0, 0])[0] += 1
+
+    def setTimedOut(self, units, timedOut):
+        # Re-publish the last values of the units with the new TimedOut flag
+        for unit in units:
+            if timedOut:
+                self.timedOut.add(unit)
+            else:
+                self.timedOut.discard(unit)
+            if unit in self.pending:
+                (nValue, sValue, TimedOut) = self.pending[unit]
+            elif unit in self.shadow:
+                (nValue, sValue, TimedOut, lastTime) = self.shadow[unit]
+            elif unit in Devices:
+                (nValue, sValue) = (Devices[unit].nValue, Devices[unit].sValue)
+            else:
+                continue
+            self.update(unit, nValue, sValue)
+
+    def withinDeadband(self, unit, old, new):
+        deadband = self.deadbands.get(unit, 0)
+        if not deadband:
+            return False
+        oldFields = old.split(';')
+        newFields = new.split(';')
+        if len(oldFields) != len(newFields):
             return False
-        
         try:
-            result = client.write_registers(address=start, values=payload, slave=self.__SETTINGS['unitId'])
-        except:
-            #Domoticz.Debug(result) 
-            Domoticz.Debug("Unable to write multiple registers.")
-            client.close()
+            return all(abs(float(a) - float(b)) < deadband for (a, b) in zip(oldFields, newFields))
+        except ValueError:
             return False
 
-        client.close()
-        return(True)
+    def flush(self):
+        now = time.monotonic()
+        for (unit, (nValue, sValue, TimedOut)) in self.pending.items():
+            # Make sure that the Domoticz device still exists (they can be deleted) before updating it
+            if unit not in Devices:
+                continue
+            Devices[unit].Update(nValue=nValue, sValue=sValue, TimedOut=TimedOut)
+            Domoticz.Debug("Update {}: {} - {} - {}".format(Devices[unit].Name, nValue, sValue, TimedOut))
+            self.shadow[unit] = (nValue, sValue, TimedOut, now)
+            self.counters['issued'] += 1
+        self.pending.clear()
 
-        
-global _plugin
-_plugin = BasePlugin()
+    def stats(self):
+        return dict(self.counters, shadowed=len(self.shadow))
 
-def onStart():
-    global _plugin
-    _plugin.onStart()
 
-def onStop():
-    global _plugin
-    _plugin.onStop()
+################################################################################
+# Metrics
+################################################################################
 
-def onHeartbeat():
-    global _plugin
-    _plugin.onHeartbeat()
+class Metrics:
+    # Counters, gauges and latency histograms labelled by target or host.
+    # Recorded from the worker threads and the plugin thread, exported as a
+    # JSON snapshot and as Prometheus text.
 
-def onCommand(Unit, Command, Level, Color):
-    global _plugin
-    _plugin.onCommand(Unit, Command, Level)
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+    def count(self, name, labels, value=1):
+        with self.lock:
+            family = self.counters.setdefault(name, {})
+            family[labels] = family.get(labels, 0) + value
+
+    def setCounter(self, name, labels, value):
+        with self.lock:
+            self.counters.setdefault(name, {})[labels] = value
+
+    def setGauge(self, name, labels, value):
+        with self.lock:
+            self.gauges.setdefault(name, {})[labels] = value
+
+    def observe(self, name, labels, seconds):
+        with self.lock:
+            family = self.histograms.setdefault(name, {})
+            if labels not in family:
+                # Per bucket counts (the last one is +Inf), count, sum
+                family[labels] = [[0] * (len(self.BUCKETS) + 1), 0, 0.0]
+            histogram = family[labels]
+            index = 0
+            while index < len(self.BUCKETS) and seconds > self.BUCKETS[index]:
+                index += 1
+            histogram[0][index] += 1
+            histogram[1] += 1
+            histogram[2] += seconds
+
+    def recordRequest(self, target, seconds, size, succeeded):
+        labels = (('target', target),)
+        self.observe('modbus_request_seconds', labels, seconds)
+        self.count('modbus_requests_total', labels)
+        self.count('modbus_bytes_total', labels, size)
+        if not succeeded:
+            self.count('modbus_failures_total', labels)
+
+    def value(self, name, labels):
+        with self.lock:
+            return self.counters.get(name, self.gauges.get(name, {})).get(labels, 0)
+
+    def snapshot(self):
+        with self.lock:
+            snapshot = {'time': time.time(), 'counters': {}, 'gauges': {}, 'histograms': {}}
+            for (kind, families) in (('counters', self.counters), ('gauges', self.gauges)):
+                for (name, family) in families.items():
+                    snapshot[kind][name] = [dict(labels, value=value) for (labels, value) in family.items()]
+            for (name, family) in self.histograms.items():
+                snapshot['histograms'][name] = [dict(labels,
+                    buckets=dict(zip([str(bound) for bound in self.BUCKETS] + ['+Inf'], buckets)),
+                    count=count, sum=round(total, 6)) for (labels, (buckets, count, total)) in family.items()]
+            return snapshot
+
+    def prometheus(self, prefix):
+        def labelText(labels):
+            text = ','.join('{}="{}"'.format(key, str(value).replace('\\', '\\\\').replace('"', '\\"')) for (key, value) in labels)
+            return '{' + text + '}' if text else ''
+
+        lines = []
+        with self.lock:
+            for (kind, families) in (('counter', self.counters), ('gauge', self.gauges)):
+                for (name, family) in sorted(families.items()):
+                    lines.append("# TYPE {}_{} {}".format(prefix, name, kind))
+                    for (labels, value) in family.items():
+                        lines.append("{}_{}{} {}".format(prefix, name, labelText(labels), value))
+            for (name, family) in sorted(self.histograms.items()):
+                lines.append("# TYPE {}_{} histogram".format(prefix, name))
+                for (labels, (buckets, count, total)) in family.items():
+                    cumulative = 0
+                    for (bound, bucket) in zip([str(bound) for bound in self.BUCKETS] + ['+Inf'], buckets):
+                        cumulative += bucket
+                        lines.append("{}_{}_bucket{} {}".format(prefix, name, labelText(labels + (('le', bound),)), cumulative))
+                    lines.append("{}_{}_sum{} {}".format(prefix, name, labelText(labels), round(total, 6)))
+                    lines.append("{}_{}_count{} {}".format(prefix, name, labelText(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+################################################################################
+# Publishing
+################################################################################
+
+class Publisher(threading.Thread):
+    # Delivers poll records (time, target, group, values) to the sinks in
+    # batches from its own thread. The queue is bounded: when the sinks fall
+    # behind, the oldest records are dropped, so polling never waits. A sink
+    # which fails is skipped for RETRY_DELAY seconds.
+
+    BATCH = 100
+    RETRY_DELAY = 10
+
+    def __init__(self, sinks, capacity):
+        super().__init__(name="SolaxPublisher", daemon=True)
+        self.sinks = sinks
+        self.records = queue.Queue(capacity)
+        self.stopping = False
+        self.retryAt = {sink: 0 for sink in sinks}
+        self.counters = {
+            'queued': 0,
+            'published': 0,
+            'dropped': 0,
+            'failed': 0,
+            }
+
+    def publish(self, record):
+        # Called from the main thread, never blocks
+        self.counters['queued'] += 1
+        while True:
+            try:
+                self.records.put_nowait(record)
+                return
+            except queue.Full:
+                pass
+            try:
+                self.records.get_nowait()
+                self.counters['dropped'] += 1
+            except queue.Empty:
+                pass
+
+    def run(self):
+        while True:
+            try:
+                batch = [self.records.get(timeout=1)]
+            except queue.Empty:
+                if self.stopping:
+                    return
+                continue
+            while len(batch) < self.BATCH:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+
+            now = time.monotonic()
+            for sink in self.sinks:
+                if now < self.retryAt[sink]:
+                    self.counters['failed'] += len(batch)
+                    continue
+                try:
+                    sink.send(batch)
+                    self.counters['published'] += len(batch)
+                except Exception as err:
+                    Domoticz.Error("Unable to publish to {}: {}".format(sink, err))
+                    sink.close()
+                    self.counters['failed'] += len(batch)
+                    self.retryAt[sink] = now + self.RETRY_DELAY
+
+    def stop(self):
+        # Records already queued are still delivered
+        self.stopping = True
+        self.join(10)
+        for sink in self.sinks:
+            sink.close()
+
+
+class MqttSink:
+    # Minimal MQTT 3.1.1 publisher (QoS 0, clean session, keep alive off),
+    # enough for a local broker without another dependency. Each record is
+    # one JSON message on <topic>/<target>/<group>.
+
+    TIMEOUT = 5
+
+    def __init__(self, host, port, topic, clientId):
+        self.host = host
+        self.port = port
+        self.topic = topic
+        self.clientId = clientId
+        self.sock = None
+
+    def __str__(self):
+        return "MQTT broker {}:{}".format(self.host, self.port)
+
+    @staticmethod
+    def string(text):
+        data = text.encode('utf-8')
+        return struct.pack('>H', len(data)) + data
+
+    @staticmethod
+    def packet(header, payload):
+        # Fixed header with the variable length encoding of the remaining length
+        length = len(payload)
+        data = bytearray([header])
+        while True:
+            (length, digit) = divmod(length, 128)
+            data.append(digit | 0x80 if length else digit)
+            if not length:
+                break
+        return bytes(data) + payload
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port), self.TIMEOUT)
+        try:
+            sock.sendall(self.packet(0x10, self.string('MQTT') + bytes([4, 0x02]) + struct.pack('>H', 0) + self.string(self.clientId)))
+            ack = b''
+            while len(ack) < 4:
+                data = sock.recv(4 - len(ack))
+                if not data:
+                    raise ConnectionError("connection closed by broker")
+                ack += data
+            if ack[0] != 0x20 or ack[3] != 0:
+                raise ConnectionError("connection refused by broker ({})".format(ack[3]))
+        except:
+            sock.close()
+            raise
+        self.sock = sock
+
+    def send(self, records):
+        if self.sock is None:
+            self.connect()
+        messages = []
+        for (timestamp, name, group, values) in records:
+            topic = "{}/{}/{}".format(self.topic, ''.join(c if c.isalnum() else '_' for c in name), group)
+            payload = json.dumps(dict(values, time=round(timestamp, 3)), separators=(',', ':')).encode('utf-8')
+            messages.append(self.packet(0x30, self.string(topic) + payload))
+        self.sock.sendall(b''.join(messages))
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.sendall(self.packet(0xe0, b''))
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+
+class InfluxSink:
+    # Records as InfluxDB line protocol, one line per record:
+    # solax,target=<target>,group=<group> <field>=<value>i,... <time ns>
+
+    @staticmethod
+    def escape(text):
+        return text.replace('\\', '\\\\').replace(',', '\\,').replace('=', '\\=').replace(' ', '\\ ')
+
+    @classmethod
+    def lines(cls, records):
+        lines = []
+        for (timestamp, name, group, values) in records:
+            fields = []
+            for (key, value) in values.items():
+                if isinstance(value, str):
+                    fields.append('{}="{}"'.format(key, value.replace('\\', '\\\\').replace('"', '\\"')))
+                elif isinstance(value, int):
+                    fields.append('{}={}i'.format(key, value))
+                else:
+                    fields.append('{}={}'.format(key, value))
+            lines.append("solax,target={},group={} {} {}\n".format(cls.escape(name), group, ','.join(fields), int(timestamp * 1e9)))
+        return lines
+
+    def close(self):
+        pass
+
+
+class InfluxFileSink(InfluxSink):
+    # Appends to a file, e.g. for the Telegraf tail input; the file is moved
+    # to <path>.1 once it reaches MAX_SIZE
+
+    MAX_SIZE = 10 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+
+    def __str__(self):
+        return self.path
+
+    def send(self, records):
+        with open(self.path, 'a') as lineFile:
+            lineFile.writelines(self.lines(records))
+            size = lineFile.tell()
+        if size >= self.MAX_SIZE:
+            os.replace(self.path, self.path + '.1')
+
+
+class InfluxUdpSink(InfluxSink):
+    # InfluxDB / Telegraf UDP listener; lines are packed into datagrams of
+    # up to MAX_DATAGRAM bytes
+
+    MAX_DATAGRAM = 1400
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sock = None
+
+    def __str__(self):
+        return "InfluxDB UDP listener {}:{}".format(self.host, self.port)
+
+    def send(self, records):
+        if self.sock is None:
+            (family, kind, proto, name, address) = socket.getaddrinfo(self.host, self.port, type=socket.SOCK_DGRAM)[0]
+            self.sock = socket.socket(family, kind, proto)
+            self.sock.connect(address)
+        datagram = b''
+        for line in self.lines(records):
+            data = line.encode('utf-8')
+            if datagram and len(datagram) + len(data) > self.MAX_DATAGRAM:
+                self.sock.send(datagram)
+                datagram = b''
+            datagram += data
+        if datagram:
+            self.sock.send(datagram)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+################################################################################
+# Persistent state
+################################################################################
+
+class StateStore:
+    # Plugin state kept in a JSON file next to the plugin, so that it survives
+    # restarts. The file is replaced atomically on every save.
+
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as stateFile:
+                self.data = json.load(stateFile)
+        except FileNotFoundError:
+            self.data = {}
+        except (OSError, ValueError) as err:
+            Domoticz.Error("Unable to load plugin state from {}: {}".format(self.path, err))
+            self.data = {}
+
+    def save(self):
+        try:
+            WriteFileAtomically(self.path, json.dumps(self.data))
+        except OSError as err:
+            Domoticz.Error("Unable to save plugin state to {}: {}".format(self.path, err))
 
 
 ################################################################################
 # Generic helper functions
 ################################################################################
 
+def WriteFileAtomically(path, text):
+    # Readers see either the old or the new file, never a partial one
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as textFile:
+        textFile.write(text)
+        textFile.flush()
+        os.fsync(textFile.fileno())
+    os.replace(temporary, path)
+
+def SplitHostPort(value, port):
+    # 'host', 'host:port' or '[ipv6]:port'
+    (host, sep, text) = value.rpartition(':')
+    if not sep or host.count(':') and not host.startswith('['):
+        (host, text) = (value, str(port))
+    host = host.strip('[]')
+    if not host or not text.isdigit() or not 1 <= int(text) <= 65535:
+        raise ValueError("'{}' is not a valid host:port.".format(value))
+    return (host, int(text))
+
 def DumpConfigToLog():
     for x in Parameters:
         if Parameters[x] != "":
@@ -841,26 +3227,3 @@ def DumpConfigToLog():
         Domoticz.Debug("Device nValue:    {}".format(Devices[x].nValue))
         Domoticz.Debug("Device sValue:   '{}'".format(Devices[x].sValue))
         Domoticz.Debug("Device LastLevel: {}".format(Devices[x].LastLevel))
-
-def UpdateDevice(Unit, nValue, sValue, TimedOut=0, MaxUpdateInterval=10, AlwaysUpdate=False):
-    # Make sure that the Domoticz device still exists (they can be deleted) before updating it
-    if Unit in Devices:
-        # try/catch due to http://bugs.python.org/issue27400
-        try:
-            timeDiff = datetime.now() - datetime.strptime(Devices[Unit].LastUpdate,'%Y-%m-%d %H:%M:%S')
-        except TypeError:
-            timeDiff = datetime.now() - datetime(*(time.strptime(Devices[Unit].LastUpdate,'%Y-%m-%d %H:%M:%S')[0:6]))
-        
-        if (
-            Devices[Unit].nValue != nValue
-            or Devices[Unit].sValue != sValue
-            or Devices[Unit].TimedOut != TimedOut
-            or (timeDiff.seconds/60)%60 > MaxUpdateInterval
-            or AlwaysUpdate
-        ):
-            Devices[Unit].Update(nValue=nValue, sValue=str(sValue), TimedOut=TimedOut)
-            Domoticz.Debug(
-                "Update {}: {} - {} - {}".format(
-                    Devices[Unit].Name, nValue, sValue, TimedOut
-                )
-            )
@@ -0,0 +1,17 @@
+# Domoticz stub for the unit tests, installed before plugin is imported
+
+import os
+import sys
+import types
+
+
+def installDomoticzStub():
+    module = types.ModuleType('Domoticz')
+    module.Debug = lambda message: None
+    module.Log = lambda message: None
+    module.Status = lambda message: None
+    module.Error = lambda message: None
+    module.Debugging = lambda level: None
+    module.Heartbeat = lambda interval: None
+    sys.modules['Domoticz'] = module
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
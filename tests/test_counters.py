@@ -0,0 +1,87 @@
+# Unit tests of the energy counter filter and accumulator
+#
+# python -m unittest discover tests
+
+import unittest
+
+from stubs import installDomoticzStub
+
+installDomoticzStub()
+from plugin import CounterFilter, EnergyTotal
+
+
+SPAN = 2 ** 32 * 100
+RESOLUTION = 100
+
+
+class CounterFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        # 10 kW at most, reads every 60 s: up to 250 Wh + resolution per read
+        self.filter = CounterFilter(10000)
+        self.time = 0
+
+    def read(self, raw):
+        self.time += 60
+        return self.filter.filter('evEnergy', raw, self.time, SPAN, RESOLUTION)
+
+    def testAcceptsIncrease(self):
+        self.assertEqual(self.read(5000), 5000)
+        self.assertEqual(self.read(5100), 5100)
+        self.assertEqual(self.filter.counts['accepted'], 2)
+
+    def testRejectsSpike(self):
+        self.read(5000)
+        self.assertEqual(self.read(900000), 5000)
+        self.assertEqual(self.read(5100), 5100)
+        self.assertEqual(self.filter.counts['rebased'], 0)
+
+    def testResetKeepsEnergyCountedFromZero(self):
+        self.read(5000)
+        # The counter restarts from 0 and counts 100 Wh per read
+        self.assertEqual(self.read(100), 5000)
+        self.assertEqual(self.read(200), 5000)
+        self.assertEqual(self.read(300), 5300)
+        self.assertEqual(self.filter.counts['rebased'], 1)
+        self.assertEqual(self.read(400), 5400)
+
+    def testReplacedCounterContinuesFromFirstValue(self):
+        self.read(5000)
+        self.assertEqual(self.read(70000), 5000)
+        self.assertEqual(self.read(70100), 5000)
+        self.assertEqual(self.read(70200), 5200)
+        self.assertEqual(self.read(70300), 5300)
+
+    def testWraparound(self):
+        self.read(SPAN - 100)
+        self.assertEqual(self.read(100), SPAN + 100)
+        self.assertEqual(self.filter.counts['wrapped'], 1)
+
+    def testState(self):
+        self.read(5000)
+        restored = CounterFilter(10000, self.filter.state())
+        self.assertEqual(restored.filter('evEnergy', 5100, self.time + 60, SPAN, RESOLUTION), 5100)
+
+
+class EnergyTotalTest(unittest.TestCase):
+
+    def testSessionResetThroughFilter(self):
+        counters = CounterFilter(10000)
+        total = EnergyTotal({'energy': 1000, 'counter': None})
+        readings = [5000, 5100, 100, 200, 300, 400]
+        for (index, raw) in enumerate(readings):
+            total.add(counters.filter('evEnergy', raw, (index + 1) * 60, SPAN, RESOLUTION))
+        # 100 Wh before the reset, 400 Wh counted from 0 after it
+        self.assertEqual(total.energy, 1500)
+
+    def testState(self):
+        total = EnergyTotal()
+        total.add(100)
+        total.add(250)
+        restored = EnergyTotal(total.state())
+        restored.add(300)
+        self.assertEqual(restored.energy, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()
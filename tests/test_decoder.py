@@ -0,0 +1,86 @@
+# Unit tests of the register decoders
+#
+# python -m unittest discover tests
+
+import random
+import unittest
+from array import array
+
+from stubs import installDomoticzStub
+
+installDomoticzStub()
+from plugin import BasePlugin
+
+try:
+    from pymodbus.constants import Endian
+    from pymodbus.payload import BinaryPayloadDecoder
+except ImportError:
+    BinaryPayloadDecoder = None
+
+
+IMAGES = 1000
+
+
+def randomImages(registerMap, count, width=None):
+    generator = random.Random(0x5a1a)
+    width = width or registerMap.length
+    return array('H', (generator.getrandbits(16) for index in range(count * width)))
+
+
+class RegisterMapTest(unittest.TestCase):
+
+    def setUp(self):
+        self.registerMaps = BasePlugin().compileRegisterMaps()
+
+    def testBatchMatchesLiveDecoder(self):
+        for (group, registerMap) in self.registerMaps.items():
+            registers = randomImages(registerMap, IMAGES)
+            columns = registerMap.decodeBatch(registers)
+            width = registerMap.length
+            for row in range(IMAGES):
+                values = registerMap.decode(registers[row * width:(row + 1) * width])
+                for (name, column) in columns.items():
+                    self.assertEqual(values[name], column[row], "{} image {} field {}".format(group, row, name))
+
+    def testBatchWithWiderImages(self):
+        registerMap = self.registerMaps['inverter']
+        width = registerMap.length + 3
+        registers = randomImages(registerMap, 10, width)
+        columns = registerMap.decodeBatch(registers, width)
+        for row in range(10):
+            values = registerMap.decode(registers[row * width:row * width + registerMap.length])
+            for (name, column) in columns.items():
+                self.assertEqual(values[name], column[row])
+
+    def testBatchRejectsPartialImages(self):
+        registerMap = self.registerMaps['evInput']
+        with self.assertRaises(ValueError):
+            registerMap.decodeBatch(array('H', bytes(2 * registerMap.length + 2)))
+
+    @unittest.skipIf(BinaryPayloadDecoder is None, "pymodbus without BinaryPayloadDecoder")
+    def testLiveDecoderMatchesPayloadDecoder(self):
+        # The decoder used before the register tables: big endian bytes,
+        # low word first
+        methods = {
+            'uint16': 'decode_16bit_uint',
+            'int16': 'decode_16bit_int',
+            'uint32': 'decode_32bit_uint',
+            'int32': 'decode_32bit_int',
+            }
+        for (group, registerMap) in self.registerMaps.items():
+            registers = randomImages(registerMap, IMAGES)
+            width = registerMap.length
+            for row in range(IMAGES):
+                image = registers[row * width:(row + 1) * width]
+                values = registerMap.decode(image)
+                for (name, offset, type, scale, unit, fmtValue) in registerMap.fields:
+                    if type not in methods:
+                        continue
+                    decoder = BinaryPayloadDecoder.fromRegisters(list(image[offset:offset + 2]),
+                        byteorder=Endian.BIG, wordorder=Endian.LITTLE)
+                    expected = getattr(decoder, methods[type])() * scale
+                    self.assertEqual(values[name], expected, "{} image {} field {}".format(group, row, name))
+
+
+if __name__ == '__main__':
+    unittest.main()
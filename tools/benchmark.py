@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Name: Solax Inverter MODBUS plugin benchmark
+# Author: Martin Saidl
+#
+# Runs the plugin against the local simulator with a stub Domoticz module and
+# reports poll cycle latency percentiles, ModBus requests and bytes per cycle
+# and CPU time per heartbeat. Requires pymodbus, like the plugin itself.
+#
+# Usage: python3 tools/benchmark.py --cycles 50 --latency 30 --jitter 10
+#
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from simulator import SolaxSimulator
+
+
+# Domoticz stub
+# =============
+
+class StubDevice:
+
+    def __init__(self, Unit=0, Name="", Type=0, Subtype=0, Switchtype=0, Options=None, Used=0, **kwargs):
+        self.Unit = Unit
+        self.ID = Unit
+        self.Name = Name
+        self.Type = Type
+        self.SubType = Subtype
+        self.SwitchType = Switchtype
+        self.Options = Options or {}
+        self.Used = Used
+        self.nValue = 0
+        self.sValue = ""
+        self.TimedOut = 0
+        self.LastLevel = 0
+        self.LastUpdate = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.updates = 0
+
+    def Create(self):
+        Devices[self.Unit] = self
+
+    def Update(self, nValue=None, sValue=None, TimedOut=None, Options=None, **kwargs):
+        if nValue is not None:
+            self.nValue = nValue
+        if sValue is not None:
+            self.sValue = sValue
+        if TimedOut is not None:
+            self.TimedOut = TimedOut
+        if Options is not None:
+            self.Options = Options
+        self.LastUpdate = time.strftime('%Y-%m-%d %H:%M:%S')
+        self.updates += 1
+
+    def Delete(self):
+        Devices.pop(self.Unit, None)
+
+
+Devices = {}
+
+
+def installDomoticzStub(verbose):
+    def log(message):
+        if verbose:
+            print(message)
+
+    module = types.ModuleType('Domoticz')
+    module.Debug = log
+    module.Log = log
+    module.Status = log
+    module.Error = lambda message: print("ERROR: {}".format(message))
+    module.Debugging = lambda level: None
+    module.Heartbeat = lambda interval: None
+    module.Device = StubDevice
+    sys.modules['Domoticz'] = module
+
+
+# Benchmark
+# =========
+
+def percentile(values, share):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(round(share * (len(values) - 1))))]
+
+
+def runCycle(plugin, timeout):
+    # One poll of all targets, driven through onHeartbeat like Domoticz does.
+    # The EV Charger poll is not waited for, so it is only forced once the
+    # previous one has left the queue; a new one would supersede it.
+    for target in plugin._plugin.targets:
+        target['nextPoll'] = 0
+        worker = target['worker']
+        with worker.condition:
+            queued = {job['key'] for job in worker.jobs}
+        if not queued & {(target['name'], 'evInput'), (target['name'], 'evHolding')}:
+            target['evNextPoll'] = 0
+
+    cpu = []
+    start = time.perf_counter()
+    while True:
+        cpuStart = time.thread_time()
+        plugin.onHeartbeat()
+        cpu.append(time.thread_time() - cpuStart)
+        if not any(target['pendingReads'] for target in plugin._plugin.targets):
+            break
+        if time.perf_counter() - start > timeout:
+            return (None, cpu)
+        time.sleep(0.005)
+    return (time.perf_counter() - start, cpu)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Solax plugin end-to-end benchmark")
+    parser.add_argument('--cycles', type=int, default=20)
+    parser.add_argument('--ev', action='store_true', help="simulate a connected EV Charger")
+    parser.add_argument('--latency', type=float, default=0, help="simulator latency in ms")
+    parser.add_argument('--jitter', type=float, default=0, help="simulator latency jitter in ms")
+    parser.add_argument('--drop-rate', type=float, default=0)
+    parser.add_argument('--timeout-rate', type=float, default=0)
+    parser.add_argument('--settings', default="", help="plugin advanced settings (Mode5)")
+    parser.add_argument('--cycle-timeout', type=float, default=120)
+    parser.add_argument('--verbose', action='store_true', help="print plugin debug log")
+    args = parser.parse_args()
+
+    simulator = SolaxSimulator(port=0, evCharger=args.ev, latency=args.latency, jitter=args.jitter,
+        dropRate=args.drop_rate, timeoutRate=args.timeout_rate).start()
+
+    installDomoticzStub(args.verbose)
+    import plugin
+    plugin.Devices = Devices
+    plugin.Parameters = {
+        'Address': simulator.host,
+        'Port': str(simulator.port),
+        'Mode1': '10',
+        'Mode2': '1',
+        'Mode3': '',
+        'Mode5': args.settings,
+        'Mode6': 'Debug' if args.verbose else 'Normal',
+        'HomeFolder': tempfile.mkdtemp(prefix='solax-benchmark-'),
+        'HardwareID': 1,
+        }
+
+    startTime = time.perf_counter()
+    plugin.onStart()
+    startTime = time.perf_counter() - startTime
+
+    # The first poll publishes every device; keep it out of the statistics
+    runCycle(plugin, args.cycle_timeout)
+
+    latencies = []
+    heartbeatCpu = []
+    requests = []
+    traffic = []
+    processCpu = []
+    writes = []
+    failed = 0
+    for cycle in range(args.cycles):
+        before = dict(simulator.counters)
+        updates = sum(device.updates for device in Devices.values())
+        cpuStart = time.process_time()
+        (latency, cpu) = runCycle(plugin, args.cycle_timeout)
+        processCpu.append(time.process_time() - cpuStart)
+        heartbeatCpu.extend(cpu)
+        requests.append(simulator.counters['requests'] - before['requests'])
+        traffic.append(simulator.counters['bytesIn'] + simulator.counters['bytesOut'] - before['bytesIn'] - before['bytesOut'])
+        writes.append(sum(device.updates for device in Devices.values()) - updates)
+        if latency is None:
+            failed += 1
+        else:
+            latencies.append(latency)
+
+    plugin.onStop()
+    simulator.stop()
+
+    cycles = max(1, args.cycles)
+    print("Startup:                  {:.1f} ms".format(startTime * 1000))
+    print("Cycles:                   {} ({} timed out)".format(args.cycles, failed))
+    print("Cycle latency p50/p90/p99/max: {:.1f} / {:.1f} / {:.1f} / {:.1f} ms".format(
+        *[percentile(latencies, share) * 1000 for share in (0.5, 0.9, 0.99, 1.0)]))
+    print("Requests per cycle:       {:.1f}".format(sum(requests) / cycles))
+    print("Bytes per cycle:          {:.0f}".format(sum(traffic) / cycles))
+    print("Device writes per cycle:  {:.1f}".format(sum(writes) / cycles))
+    print("CPU per heartbeat:        {:.3f} ms (p99 {:.3f} ms)".format(
+        sum(heartbeatCpu) / max(1, len(heartbeatCpu)) * 1000, percentile(heartbeatCpu, 0.99) * 1000))
+    print("Process CPU per cycle:    {:.2f} ms".format(sum(processCpu) / cycles * 1000))
+    print("Simulator:                {}".format(simulator.counters))
+
+
+if __name__ == "__main__":
+    main()
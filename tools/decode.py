@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Name: Solax Inverter MODBUS register dump decoder
+# Author: Martin Saidl
+#
+# Decodes recorded register dumps offline with the plugin's register maps.
+# A dump is a sequence of register images, each starting at register 0 of
+# the group: raw little-endian 16-bit words (--format bin) or one image of
+# comma separated values per line (--format csv). All images are decoded in
+# one batch and written as CSV columns, or summarised. Requires pymodbus,
+# like the plugin itself.
+#
+# Usage: python3 tools/decode.py dump.bin --width 290 --fields pv1Power,gridPower
+#
+
+import argparse
+import csv
+import os
+import sys
+import time
+from array import array
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import installDomoticzStub
+
+
+def loadDump(path, fmt, width):
+    registers = array('H')
+    if fmt == 'bin':
+        with open(path, 'rb') as dumpFile:
+            registers.frombytes(dumpFile.read())
+        if sys.byteorder == 'big':
+            registers.byteswap()
+    else:
+        with open(path, 'r') as dumpFile:
+            for line in dumpFile:
+                if line.strip():
+                    row = [int(value) & 0xffff for value in line.split(',')]
+                    if len(row) != width:
+                        raise ValueError("CSV row of {} values, expected {}.".format(len(row), width))
+                    registers.extend(row)
+    return registers
+
+
+def verify(registerMap, registers, width, columns):
+    # Compare the batch result with the live decoder, image by image
+    mismatches = 0
+    for row in range(len(registers) // width):
+        values = registerMap.decode(registers[row * width:(row + 1) * width])
+        for (name, column) in columns.items():
+            if values[name] != column[row]:
+                mismatches += 1
+                if mismatches <= 10:
+                    print("Mismatch in image {} field {}: {} != {}".format(row, name, values[name], column[row]), file=sys.stderr)
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Solax register dump decoder")
+    parser.add_argument('dump')
+    parser.add_argument('--group', default='inverter', choices=('inverter', 'config', 'evInput', 'evHolding'),
+        help="register group of the images")
+    parser.add_argument('--format', default='bin', choices=('bin', 'csv'))
+    parser.add_argument('--width', type=int, default=0, help="registers per image (default: register map length)")
+    parser.add_argument('--fields', default='', help="comma separated fields to output (default: all)")
+    parser.add_argument('--output', default='-', help="CSV output file")
+    parser.add_argument('--summary', action='store_true', help="print min / mean / max per field instead of CSV")
+    parser.add_argument('--verify', action='store_true', help="check the result against the live decoder")
+    args = parser.parse_args()
+
+    installDomoticzStub(False)
+    import plugin
+    registerMap = plugin.BasePlugin().compileRegisterMaps()[args.group]
+    width = args.width or registerMap.length
+
+    registers = loadDump(args.dump, args.format, width)
+    started = time.perf_counter()
+    columns = registerMap.decodeBatch(registers, width)
+    elapsed = time.perf_counter() - started
+    images = len(registers) // width
+    print("Decoded {} image(s) in {:.1f} ms.".format(images, elapsed * 1000), file=sys.stderr)
+
+    if args.fields:
+        columns = {name.strip(): columns[name.strip()] for name in args.fields.split(',')}
+
+    if args.verify:
+        mismatches = verify(registerMap, registers, width, columns)
+        print("Verification: {} mismatch(es).".format(mismatches), file=sys.stderr)
+        if mismatches:
+            sys.exit(1)
+
+    if args.summary:
+        for (name, column) in columns.items():
+            if isinstance(column, array) and len(column):
+                print("{:24} min {:>12} mean {:>14.2f} max {:>12}".format(name, min(column), sum(column) / len(column), max(column)))
+        return
+
+    output = sys.stdout if args.output == '-' else open(args.output, 'w', newline='')
+    writer = csv.writer(output)
+    writer.writerow(columns.keys())
+    writer.writerows(zip(*columns.values()))
+    if output is not sys.stdout:
+        output.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Name: Solax Inverter MODBUS traffic replay
+# Author: Martin Saidl
+#
+# Feeds ModBus traffic recorded by the plugin (advanced setting record=1)
+# back into the plugin in place of ModbusTcpClient, with a stub Domoticz
+# module. Requests are answered from the log in recorded order; --speed 1
+# keeps the recorded timing, --speed 10 runs ten times faster and --speed 0
+# as fast as possible. Reports replay speed, device writes and the decode /
+# device update cost measured by the plugin. Requires pymodbus, like the
+# plugin itself.
+#
+# Usage: python3 tools/replay.py solax-1-192_168_1_20_502.modbus.1 solax-1-192_168_1_20_502.modbus --speed 0
+#
+
+import argparse
+import collections
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import Devices, installDomoticzStub, runCycle
+
+
+class ReplayResponse:
+
+    def __init__(self, registers):
+        self.registers = list(registers)
+
+    def isError(self):
+        return False
+
+
+class TrafficPlayer:
+    # Recorded transactions queued per request (function, unit, address,
+    # count), so requests are matched even when the plugin orders its jobs
+    # differently from the recording
+
+    def __init__(self, records, speed):
+        self.speed = speed
+        self.queues = collections.defaultdict(collections.deque)
+        for record in sorted(records, key=lambda record: record[0]):
+            (started, duration, function, unitId, status, address, count, words) = record
+            self.queues[(function, unitId, address, count)].append(record)
+        self.remaining = len(records)
+        self.span = (records[-1][0] - records[0][0]) if records else 0
+        self.origin = None
+        self.counters = {
+            'served': 0,
+            'missed': 0,
+            'failures': 0,
+            }
+
+    def answer(self, function, unitId, address, count):
+        from plugin import TrafficRecorder
+        from pymodbus.pdu import ExceptionResponse
+
+        queue = self.queues.get((function, unitId, address, count))
+        if not queue:
+            self.counters['missed'] += 1
+            raise ConnectionError("No recorded transaction for function {} unit {} address 0x{:04x} count {}.".format(function, unitId, address, count))
+        (started, duration, function, unitId, status, address, count, words) = queue.popleft()
+        self.remaining -= 1
+        self.counters['served'] += 1
+
+        if self.speed:
+            if self.origin is None:
+                self.origin = (time.monotonic(), started)
+            due = self.origin[0] + (started - self.origin[1] + duration) / self.speed
+            time.sleep(max(0, due - time.monotonic()))
+
+        if status == TrafficRecorder.STATUS_EXCEPTION:
+            return ExceptionResponse(function, words[0] if words else 0)
+        if status == TrafficRecorder.STATUS_FAILED:
+            self.counters['failures'] += 1
+            raise ConnectionError("Recorded transaction failure.")
+        return ReplayResponse(words)
+
+
+class ReplayClient:
+    # Stands in for ModbusTcpClient
+
+    def __init__(self, player, **kwargs):
+        self.player = player
+        self.open = False
+
+    def connect(self):
+        self.open = True
+        return True
+
+    def is_socket_open(self):
+        return self.open
+
+    def close(self):
+        self.open = False
+
+    def read_holding_registers(self, address, count=1, slave=0):
+        return self.player.answer(0x03, slave, address, count)
+
+    def read_input_registers(self, address, count=1, slave=0):
+        return self.player.answer(0x04, slave, address, count)
+
+    def write_register(self, address, value, slave=0):
+        return self.player.answer(0x06, slave, address, 1)
+
+    def write_registers(self, address, values, slave=0):
+        return self.player.answer(0x10, slave, address, len(values))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Solax plugin ModBus traffic replay")
+    parser.add_argument('logs', nargs='+', help="traffic logs of one host, rotated files included")
+    parser.add_argument('--speed', type=float, default=0, help="replay speed, 1 = real time, 0 = as fast as possible")
+    parser.add_argument('--unit-id', default='1', help="ModBus unit ID of the recorded inverter")
+    parser.add_argument('--settings', default="", help="plugin advanced settings (Mode5), retries=0 and evGap=0 unless set, asyncTransport is always 0")
+    parser.add_argument('--cycle-timeout', type=float, default=600)
+    parser.add_argument('--verbose', action='store_true', help="print plugin debug log")
+    args = parser.parse_args()
+
+    installDomoticzStub(args.verbose)
+    import plugin
+
+    records = []
+    for path in args.logs:
+        records.extend(plugin.TrafficRecorder.read(path))
+    player = TrafficPlayer(records, args.speed)
+    plugin.ModbusLink.clientFactory = staticmethod(lambda **kwargs: ReplayClient(player, **kwargs))
+
+    plugin.Devices = Devices
+    plugin.Parameters = {
+        'Address': 'replay',
+        'Port': '502',
+        'Mode1': '10',
+        'Mode2': args.unit_id,
+        'Mode3': '',
+        'Mode4': '',
+        # The player answers synchronously, so the async transport is off
+        'Mode5': "retries=0;evGap=0;" + args.settings + ";asyncTransport=0",
+        'Mode6': 'Debug' if args.verbose else 'Normal',
+        'HomeFolder': tempfile.mkdtemp(prefix='solax-replay-'),
+        'HardwareID': 1,
+        }
+
+    started = time.perf_counter()
+    plugin.onStart()
+    cycles = 0
+    idle = 0
+    while player.remaining and idle < 3:
+        served = player.counters['served']
+        runCycle(plugin, args.cycle_timeout)
+        cycles += 1
+        idle = idle + 1 if player.counters['served'] == served else 0
+    plugin.onStop()
+    elapsed = time.perf_counter() - started
+
+    metrics = plugin._plugin.metrics
+    print("Transactions:             {} recorded, {} left unused".format(len(records), player.remaining))
+    print("Replay:                   {}".format(player.counters))
+    print("Poll cycles:              {}".format(cycles))
+    print("Recorded span:            {:.1f} s".format(player.span))
+    print("Replay time:              {:.1f} s ({:.1f}x real time)".format(elapsed, player.span / elapsed if elapsed else 0))
+    print("Device writes:            {}".format(plugin._plugin.deviceUpdates.stats()))
+    for name in ('decode_seconds', 'flush_seconds'):
+        for (labels, (buckets, count, total)) in metrics.histograms.get(name, {}).items():
+            print("{:25} {} {} x, mean {:.3f} ms".format(name + ':', dict(labels), count, total / count * 1000 if count else 0))
+
+
+if __name__ == "__main__":
+    main()
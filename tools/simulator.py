@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Name: Solax Inverter MODBUS simulator
+# Author: Martin Saidl
+#
+# Local ModBus TCP server emulating the Solax X1/X3 G4 register map (see docs)
+# and the EV Charger block mapped at 0x1000. Used to test and benchmark the
+# plugin without a real inverter. Only the standard library is required.
+#
+# Usage: python3 tools/simulator.py --port 5020 --latency 50 --jitter 20
+#
+
+import argparse
+import math
+import random
+import socketserver
+import struct
+import threading
+import time
+
+
+class SolaxSimulator:
+
+    REGISTERS = 0x1100
+    MAX_COUNT = 125
+
+    def __init__(self, host='127.0.0.1', port=5020, unitId=1, evCharger=True, maxPower=8000,
+                 latency=0, jitter=0, dropRate=0, timeoutRate=0):
+        self.host = host
+        self.port = port
+        self.unitId = unitId
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.dropRate = dropRate
+        self.timeoutRate = timeoutRate
+        self.lock = threading.Lock()
+        self.input = [0] * self.REGISTERS
+        self.holding = [0] * self.REGISTERS
+        self.started = time.monotonic()
+        self.counters = {
+            'connections': 0,
+            'requests': 0,
+            'errors': 0,
+            'dropped': 0,
+            'timeouts': 0,
+            'bytesIn': 0,
+            'bytesOut': 0,
+            }
+        self.server = None
+        self.thread = None
+
+        # Holding registers - configuration
+        serial = 'H34A10SIM00001'
+        for index in range(7):
+            self.holding[index] = (ord(serial[2 * index]) << 8) | ord(serial[2 * index + 1])
+        self.holding[0x00ba] = maxPower
+        self.holding[0x013e] = 1 if evCharger else 0
+        self.holding[0x100d] = 1
+
+        # Input registers - static part
+        self.input[0x0008] = 42                                     # Inverter temperature
+        self.input[0x0018] = 24                                     # Battery temperature
+        self.input[0x001c] = 60                                     # Battery capacity
+        self.energy = {
+            # address: [counter, mean increase per second]
+            0x001d: [12000, 0.003],                                 # Battery out energy (0.1 kWh)
+            0x0021: [13000, 0.003],                                 # Battery in energy (0.1 kWh)
+            0x0048: [250000, 0.05],                                 # Grid export energy (0.01 kWh)
+            0x004a: [410000, 0.03],                                 # Grid import energy (0.01 kWh)
+            0x0052: [45000, 0.011],                                 # Inverter energy (0.1 kWh)
+            0x0094: [52000, 0.0125],                                # PV energy (0.1 kWh)
+            0x100f: [3500, 0.01],                                   # EV Charger energy (0.1 kWh)
+            }
+        self.updated = self.started
+        self.update()
+
+    # Register image
+    # ==============
+
+    def set16(self, registers, address, value):
+        registers[address] = value & 0xffff
+
+    def set32(self, registers, address, value):
+        # Solax word order - low word first
+        registers[address] = value & 0xffff
+        registers[address + 1] = (value >> 16) & 0xffff
+
+    def update(self):
+        # Slowly varying, plausible power values driven by the wall clock
+        t = time.monotonic() - self.started
+        pv1 = int(max(0, 2500 + 1500 * math.sin(t / 60) + random.randint(-50, 50)))
+        pv2 = int(max(0, 2000 + 1000 * math.sin(t / 45) + random.randint(-50, 50)))
+        load = int(1200 + 400 * math.sin(t / 20) + random.randint(-100, 100))
+        battery = int(1000 * math.sin(t / 30))
+        inverter = pv1 + pv2 - battery
+        grid = inverter - load
+
+        self.set16(self.input, 0x0002, inverter)
+        self.set16(self.input, 0x0009, 2)                           # Run mode - Normal
+        self.set16(self.input, 0x000a, pv1)
+        self.set16(self.input, 0x000b, pv2)
+        self.set16(self.input, 0x0016, battery)
+        self.set32(self.input, 0x0046, grid)
+        self.set16(self.input, 0x004e, 0)
+        # Energy counters grow with time, at a plausible rate
+        elapsed = time.monotonic() - self.updated
+        self.updated += elapsed
+        for (address, counter) in self.energy.items():
+            counter[0] += random.uniform(0, 2) * counter[1] * elapsed
+            self.set32(self.input, address, int(counter[0]))
+
+        # EV Charger
+        evPower = 3600 if self.holding[0x100d] else 0
+        self.set16(self.input, 0x100b, evPower)
+        self.set16(self.input, 0x101c, 28)
+        self.set16(self.input, 0x101d, 2 if evPower else 0)
+
+    def applyRemoteControl(self):
+        # Mirror the remote control block (0x007c) into its read-back registers (0x0100)
+        block = self.holding[0x007c:0x007c + 13]
+        self.input[0x0100] = block[0]
+        self.input[0x0101] = 1 if block[12] else 0
+        self.input[0x0102:0x0104] = block[2:4]
+        self.input[0x0112:0x0114] = block[8:10]
+        self.input[0x0114:0x0116] = block[10:12]
+        self.input[0x011a] = block[6]
+        self.input[0x011b] = block[7]
+        self.input[0x011e] = block[12]
+
+    # ModBus protocol
+    # ===============
+
+    def handle(self, pdu):
+        function = pdu[0]
+        try:
+            if function in (0x03, 0x04):
+                (address, count) = struct.unpack('>HH', pdu[1:5])
+                if not 1 <= count <= self.MAX_COUNT or address + count > self.REGISTERS:
+                    return self.exception(function, 0x02)
+                with self.lock:
+                    self.update()
+                    registers = self.holding if function == 0x03 else self.input
+                    values = registers[address:address + count]
+                return struct.pack('>BB{}H'.format(count), function, count * 2, *values)
+
+            if function == 0x06:
+                (address, value) = struct.unpack('>HH', pdu[1:5])
+                if address >= self.REGISTERS:
+                    return self.exception(function, 0x02)
+                with self.lock:
+                    self.holding[address] = value
+                return pdu[0:5]
+
+            if function == 0x10:
+                (address, count, length) = struct.unpack('>HHB', pdu[1:6])
+                if not 1 <= count <= 123 or address + count > self.REGISTERS or length != count * 2:
+                    return self.exception(function, 0x02)
+                values = struct.unpack('>{}H'.format(count), pdu[6:6 + length])
+                with self.lock:
+                    self.holding[address:address + count] = values
+                    if address == 0x007c:
+                        self.applyRemoteControl()
+                return struct.pack('>BHH', function, address, count)
+        except struct.error:
+            return self.exception(function, 0x03)
+
+        return self.exception(function, 0x01)
+
+    def exception(self, function, code):
+        self.counters['errors'] += 1
+        return struct.pack('>BB', function | 0x80, code)
+
+    # Server
+    # ======
+
+    def start(self):
+        simulator = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                simulator.serve(self.request)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.server = socketserver.ThreadingTCPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name="SolaxSimulator", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def serve(self, connection):
+        self.counters['connections'] += 1
+        stream = b''
+        while True:
+            try:
+                data = connection.recv(1024)
+            except OSError:
+                return
+            if not data:
+                return
+            self.counters['bytesIn'] += len(data)
+            stream += data
+
+            while len(stream) >= 7:
+                (transaction, protocol, length, unitId) = struct.unpack('>HHHB', stream[0:7])
+                if len(stream) < 6 + length:
+                    break
+                pdu = stream[7:6 + length]
+                stream = stream[6 + length:]
+                self.counters['requests'] += 1
+
+                if random.random() < self.dropRate:
+                    self.counters['dropped'] += 1
+                    connection.close()
+                    return
+                if random.random() < self.timeoutRate:
+                    self.counters['timeouts'] += 1
+                    continue
+                if self.latency or self.jitter:
+                    time.sleep(max(0, self.latency + random.uniform(-self.jitter, self.jitter)))
+
+                response = self.handle(pdu)
+                frame = struct.pack('>HHHB', transaction, protocol, len(response) + 1, unitId) + response
+                try:
+                    connection.sendall(frame)
+                except OSError:
+                    return
+                self.counters['bytesOut'] += len(frame)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Solax inverter ModBus TCP simulator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5020)
+    parser.add_argument('--max-power', type=int, default=8000)
+    parser.add_argument('--no-ev', action='store_true', help="do not report a connected EV Charger")
+    parser.add_argument('--latency', type=float, default=0, help="response latency in ms")
+    parser.add_argument('--jitter', type=float, default=0, help="latency jitter in ms")
+    parser.add_argument('--drop-rate', type=float, default=0, help="probability of dropping the connection")
+    parser.add_argument('--timeout-rate', type=float, default=0, help="probability of not answering a request")
+    args = parser.parse_args()
+
+    simulator = SolaxSimulator(args.host, args.port, evCharger=not args.no_ev, maxPower=args.max_power,
+        latency=args.latency, jitter=args.jitter, dropRate=args.drop_rate, timeoutRate=args.timeout_rate).start()
+    print("Solax simulator listening on {}:{}".format(simulator.host, simulator.port))
+    try:
+        while True:
+            time.sleep(10)
+            print(simulator.counters)
+    except KeyboardInterrupt:
+        simulator.stop()
+
+
+if __name__ == "__main__":
+    main()